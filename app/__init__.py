@@ -4,6 +4,10 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_cors import CORS
 from flask_moment import Moment
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app.poster_cache import poster_cache
+from app.catalog import movie_catalog
+from app import metrics
 import logging
 
 db = SQLAlchemy()
@@ -14,6 +18,8 @@ moment = Moment()
 def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
+    if Config.PROXY_FIX_X_FOR:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=Config.PROXY_FIX_X_FOR)
 
     db.init_app(app)
     migrate.init_app(app, db)
@@ -25,9 +31,25 @@ def create_app():
     ]}})
 
     moment.init_app(app)
+    poster_cache.init_app(app)
+    movie_catalog.init_app(app)
+    metrics.init_app(app)
 
     with app.app_context():
         from . import models
+        from .recommendation_pool import recommendation_pool
+        recommendation_pool.init_app(app)
+        from .recommendations import poster_flights
+        from .recommendation_pool import recommendation_flights
+        metrics.register_stats('watchbuddy_poster_cache', 'Poster cache counters and size.', poster_cache.stats)
+        metrics.register_stats('watchbuddy_recommendation_pool', 'Recommendation pool counters and size.', recommendation_pool.stats)
+        metrics.register_stats('watchbuddy_catalog', 'Movies and index sizes in the local catalog.', movie_catalog.stats)
+        from .prefetch import page_prefetcher
+        metrics.register_stats('watchbuddy_prefetch', 'Speculative next-page prefetches.', page_prefetcher.stats)
+        metrics.register_stats('watchbuddy_poster_flights', 'Coalesced poster lookups.', poster_flights.stats)
+        metrics.register_stats('watchbuddy_recommendation_flights', 'Coalesced recommendation generations.', recommendation_flights.stats)
+        from .admission import admission_controller
+        metrics.register_stats('watchbuddy_admission', 'Admission control decisions, slots and queue.', admission_controller.stats)
         from .api import api as api_blueprint
         app.register_blueprint(api_blueprint, url_prefix='/api')
 
@@ -0,0 +1,457 @@
+import asyncio
+import hashlib
+import logging
+import math
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+from flask import g, jsonify, render_template, request
+
+from config import Config
+from app.metrics import Counter
+from app.sqlite_store import SQLiteStore
+
+admission_decisions = Counter('watchbuddy_admission_total', 'Admission decisions for recommendation requests and generations.', ['outcome', 'reason'])
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# In-process token buckets, generation slots and wait queue. Limits apply per
+# worker process.
+class LocalAdmissionBackend:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.active = {}
+        self.queue = []
+
+    # Takes a token from key's bucket. Returns 0, or the seconds until one is available.
+    def consume(self, key, rate, burst):
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / rate
+            self.buckets[key] = (tokens - 1, now)
+            if len(self.buckets) > 10000:
+                self._prune(now, rate, burst)
+            return 0
+
+    # Drops buckets that have refilled completely. Caller holds the lock.
+    def _prune(self, now, rate, burst):
+        for key in [key for key, (tokens, updated) in self.buckets.items() if tokens + (now - updated) * rate >= burst]:
+            del self.buckets[key]
+
+    # Joins the wait queue. Returns (waiters ahead, active generations), or
+    # None if the queue is full.
+    def enqueue(self, owner, max_queue):
+        with self.lock:
+            if len(self.queue) >= max_queue:
+                return None
+            self.queue.append(owner)
+            return len(self.queue) - 1, len(self.active)
+
+    # Takes a generation slot if one is free for owner's place in the queue
+    def acquire(self, owner, limit, slot_ttl):
+        now = time.time()
+        with self.lock:
+            for stale in [stale for stale, acquired in self.active.items() if now - acquired > slot_ttl]:
+                del self.active[stale]
+            free = limit - len(self.active)
+            if free <= 0 or owner not in self.queue[:free]:
+                return False
+            self.queue.remove(owner)
+            self.active[owner] = now
+            return True
+
+    # Takes a slot only if one is free and nobody is waiting for it
+    def try_acquire(self, owner, limit, slot_ttl):
+        now = time.time()
+        with self.lock:
+            for stale in [stale for stale, acquired in self.active.items() if now - acquired > slot_ttl]:
+                del self.active[stale]
+            if self.queue or len(self.active) >= limit:
+                return False
+            self.active[owner] = now
+            return True
+
+    def dequeue(self, owner):
+        with self.lock:
+            if owner in self.queue:
+                self.queue.remove(owner)
+
+    def release(self, owner):
+        with self.lock:
+            self.active.pop(owner, None)
+
+    def counts(self):
+        with self.lock:
+            return {'active': len(self.active), 'waiting': len(self.queue), 'clients': len(self.buckets)}
+
+
+# The same state in a SQLite file shared by the worker processes on a host,
+# so the limits hold for the whole gunicorn server rather than per worker
+class SQLiteAdmissionBackend(SQLiteStore):
+    def __init__(self, path):
+        super().__init__(path, (
+            "CREATE TABLE IF NOT EXISTS admission_buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)",
+            "CREATE TABLE IF NOT EXISTS admission_slots (owner TEXT PRIMARY KEY, acquired REAL)",
+            "CREATE TABLE IF NOT EXISTS admission_queue (owner TEXT PRIMARY KEY, enqueued REAL)",
+        ))
+
+    def consume(self, key, rate, burst):
+        now = time.time()
+
+        def take(conn):
+            row = conn.execute("SELECT tokens, updated FROM admission_buckets WHERE key = ?", (key,)).fetchone()
+            tokens = min(burst, row[0] + (now - row[1]) * rate) if row else burst
+            retry_after = (1 - tokens) / rate if tokens < 1 else 0
+            conn.execute(
+                "INSERT OR REPLACE INTO admission_buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                (key, tokens if retry_after else tokens - 1, now),
+            )
+            # Buckets idle long enough to have refilled are the same as no bucket
+            conn.execute("DELETE FROM admission_buckets WHERE updated < ?", (now - burst / rate,))
+            return retry_after
+
+        return self._transaction(take)
+
+    def enqueue(self, owner, max_queue):
+        def join(conn):
+            queued = conn.execute("SELECT COUNT(*) FROM admission_queue").fetchone()[0]
+            if queued >= max_queue:
+                return None
+            conn.execute("INSERT INTO admission_queue (owner, enqueued) VALUES (?, ?)", (owner, time.time()))
+            return queued, conn.execute("SELECT COUNT(*) FROM admission_slots").fetchone()[0]
+
+        return self._transaction(join)
+
+    def acquire(self, owner, limit, slot_ttl):
+        now = time.time()
+
+        def take(conn):
+            # Slots and queue entries left behind by a killed worker
+            conn.execute("DELETE FROM admission_slots WHERE acquired < ?", (now - slot_ttl,))
+            conn.execute("DELETE FROM admission_queue WHERE enqueued < ?", (now - slot_ttl,))
+            active = conn.execute("SELECT COUNT(*) FROM admission_slots").fetchone()[0]
+            row = conn.execute("SELECT enqueued FROM admission_queue WHERE owner = ?", (owner,)).fetchone()
+            if row is None or active >= limit:
+                return False
+            ahead = conn.execute(
+                "SELECT COUNT(*) FROM admission_queue WHERE enqueued < ? OR (enqueued = ? AND owner < ?)",
+                (row[0], row[0], owner),
+            ).fetchone()[0]
+            if ahead >= limit - active:
+                return False
+            conn.execute("DELETE FROM admission_queue WHERE owner = ?", (owner,))
+            conn.execute("INSERT INTO admission_slots (owner, acquired) VALUES (?, ?)", (owner, now))
+            return True
+
+        return self._transaction(take)
+
+    def try_acquire(self, owner, limit, slot_ttl):
+        now = time.time()
+
+        def take(conn):
+            conn.execute("DELETE FROM admission_slots WHERE acquired < ?", (now - slot_ttl,))
+            if conn.execute("SELECT COUNT(*) FROM admission_queue WHERE enqueued >= ?", (now - slot_ttl,)).fetchone()[0]:
+                return False
+            if conn.execute("SELECT COUNT(*) FROM admission_slots").fetchone()[0] >= limit:
+                return False
+            conn.execute("INSERT INTO admission_slots (owner, acquired) VALUES (?, ?)", (owner, now))
+            return True
+
+        return self._transaction(take)
+
+    def dequeue(self, owner):
+        self._connect().execute("DELETE FROM admission_queue WHERE owner = ?", (owner,))
+
+    def release(self, owner):
+        self._connect().execute("DELETE FROM admission_slots WHERE owner = ?", (owner,))
+
+    def counts(self):
+        conn = self._connect()
+        return {
+            'active': conn.execute("SELECT COUNT(*) FROM admission_slots").fetchone()[0],
+            'waiting': conn.execute("SELECT COUNT(*) FROM admission_queue").fetchone()[0],
+            'clients': conn.execute("SELECT COUNT(*) FROM admission_buckets").fetchone()[0],
+        }
+
+
+# A place in the generation queue
+class Waiter:
+    def __init__(self, owner, ahead, active, deadline):
+        self.owner = owner
+        self.ahead = ahead
+        self.active = active
+        self.deadline = deadline
+        self.queued = False
+
+
+# Admission control for recommendation generations: a token bucket per client,
+# checked when a request comes in, and a bound on concurrent generations
+# with a bounded wait queue, taken around each generation itself (so batch
+# items, pool refills and prefetches all count). A generation that can't get
+# a slot before its queue deadline (going by how long generations have been
+# taking) is shed straight away with a Retry-After instead of holding a worker
+# until it times out. Background work only takes a slot that's free with
+# nobody waiting, so it never delays or sheds a user's request.
+class AdmissionController:
+    def __init__(self, backend=None):
+        self._backend = backend
+        self.lock = threading.Lock()
+        self.average_hold = None
+        self.counters = {'admitted': 0, 'queued': 0, 'rate_limited': 0, 'queue_full': 0, 'deadline': 0, 'timeout': 0, 'background': 0}
+
+    @property
+    def backend(self):
+        with self.lock:
+            if self._backend is None:
+                self._backend = SQLiteAdmissionBackend(Config.ADMISSION_DB) if Config.ADMISSION_DB else LocalAdmissionBackend()
+            return self._backend
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _shed(self, status, reason, retry_after):
+        self._count(reason)
+        admission_decisions.inc('shed', reason)
+        logging.warning(f"Shedding recommendation generation ({reason}), retry after {retry_after:.1f}s")
+        raise AdmissionRejected(status, reason, max(1, math.ceil(retry_after)))
+
+    # Seconds a generation holds its slot, as an exponential moving average
+    def _observe_hold(self, seconds):
+        with self.lock:
+            if self.average_hold is None:
+                self.average_hold = seconds
+            else:
+                self.average_hold += 0.2 * (seconds - self.average_hold)
+
+    def _expected_hold(self):
+        with self.lock:
+            return self.average_hold if self.average_hold is not None else Config.ADMISSION_DEFAULT_HOLD
+
+    # Takes a token from the client's bucket or raises AdmissionRejected (429)
+    def check_rate(self, client_key):
+        if not Config.ADMISSION_ENABLED or Config.RATE_LIMIT_RATE <= 0:
+            return
+        try:
+            retry_after = self.backend.consume(client_key, Config.RATE_LIMIT_RATE, Config.RATE_LIMIT_BURST)
+        except sqlite3.Error as e:
+            logging.error(f"Admission backend unavailable, letting request through: {e}")
+            return
+        if retry_after:
+            self._shed(429, 'rate_limited', retry_after)
+
+    # Joins the wait queue, or sheds the generation if the queue is full
+    def _enqueue(self):
+        owner = uuid.uuid4().hex
+        position = self.backend.enqueue(owner, Config.ADMISSION_MAX_QUEUE)
+        if position is None:
+            self._shed(503, 'queue_full', self._expected_hold())
+        ahead, active = position
+        return Waiter(owner, ahead, active, time.time() + Config.ADMISSION_QUEUE_TIMEOUT)
+
+    # Tries once to move a waiter into a slot. Sheds it if it isn't going to
+    # get one before its deadline.
+    def _poll(self, waiter):
+        limit = Config.ADMISSION_MAX_CONCURRENT
+        if self.backend.acquire(waiter.owner, limit, Config.ADMISSION_SLOT_TTL):
+            return True
+        if not waiter.queued:
+            waiter.queued = True
+            expected_wait = (waiter.ahead // limit + 1) * self._expected_hold() if waiter.active + waiter.ahead >= limit else 0
+            if expected_wait > Config.ADMISSION_QUEUE_TIMEOUT:
+                self._shed(503, 'deadline', expected_wait)
+            self._count('queued')
+            admission_decisions.inc('queued', 'concurrency')
+        if time.time() >= waiter.deadline:
+            self._shed(503, 'timeout', self._expected_hold())
+        return False
+
+    def _admitted(self, owner, reason):
+        self._count('admitted')
+        admission_decisions.inc('admitted', reason)
+        return owner, time.perf_counter()
+
+    # Takes a free slot without queueing when nobody is waiting, so the queue
+    # only holds generations that actually have to wait
+    def _acquire_free(self):
+        owner = uuid.uuid4().hex
+        if self.backend.try_acquire(owner, Config.ADMISSION_MAX_CONCURRENT, Config.ADMISSION_SLOT_TTL):
+            return self._admitted(owner, 'immediate')
+        return None
+
+    def _acquire_background(self):
+        owner = uuid.uuid4().hex
+        if not self.backend.try_acquire(owner, Config.ADMISSION_MAX_CONCURRENT, Config.ADMISSION_SLOT_TTL):
+            self._count('background')
+            admission_decisions.inc('shed', 'background')
+            raise AdmissionRejected(503, 'background', max(1, math.ceil(self._expected_hold())))
+        return self._admitted(owner, 'background')
+
+    # Takes a generation slot, waiting in the queue if all are busy, or raises
+    # AdmissionRejected. Returns a token for release(), or None when admission
+    # is off or its backend is unavailable.
+    def acquire(self, background=False):
+        if not Config.ADMISSION_ENABLED:
+            return None
+        try:
+            if background:
+                return self._acquire_background()
+            token = self._acquire_free()
+            if token is not None:
+                return token
+            waiter = self._enqueue()
+            try:
+                while not self._poll(waiter):
+                    time.sleep(Config.ADMISSION_POLL_INTERVAL)
+            except BaseException:
+                self.backend.dequeue(waiter.owner)
+                raise
+            return self._admitted(waiter.owner, 'queued' if waiter.queued else 'immediate')
+        except sqlite3.Error as e:
+            logging.error(f"Admission backend unavailable, letting generation through: {e}")
+            return None
+
+    # asyncio version of acquire. Backend calls run in the default executor
+    # since the SQLite backend can block on its lock.
+    async def acquire_async(self):
+        if not Config.ADMISSION_ENABLED:
+            return None
+        loop = asyncio.get_running_loop()
+        try:
+            token = await loop.run_in_executor(None, self._acquire_free)
+            if token is not None:
+                return token
+            waiter = await loop.run_in_executor(None, self._enqueue)
+            try:
+                while not await loop.run_in_executor(None, self._poll, waiter):
+                    await asyncio.sleep(Config.ADMISSION_POLL_INTERVAL)
+            except BaseException:
+                self.backend.dequeue(waiter.owner)
+                raise
+            return self._admitted(waiter.owner, 'queued' if waiter.queued else 'immediate')
+        except sqlite3.Error as e:
+            logging.error(f"Admission backend unavailable, letting generation through: {e}")
+            return None
+
+    def release(self, token):
+        if token is None:
+            return
+        owner, start = token
+        self._observe_hold(time.perf_counter() - start)
+        try:
+            self.backend.release(owner)
+        except sqlite3.Error as e:
+            logging.error(f"Could not release admission slot {owner}: {e}")
+
+    # Holds a generation slot for the duration of the block
+    @contextmanager
+    def slot(self, background=False):
+        token = self.acquire(background)
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    @asynccontextmanager
+    async def slot_async(self):
+        token = await self.acquire_async()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['average_hold_ms'] = round((self.average_hold or 0) * 1000, 1)
+        try:
+            stats.update(self.backend.counts())
+        except sqlite3.Error as e:
+            logging.error(f"Could not read admission state: {e}")
+        return stats
+
+
+admission_controller = AdmissionController()
+
+# Endpoints that can trigger a generation. Each request takes a token from
+# the client's bucket (batch requests take one per item, in iter_batch_results).
+RATE_LIMITED_ENDPOINTS = {
+    'api.api_recommendations',
+    'api.form_recommendations',
+    'api.api_recommendations_stream',
+    'api.form_recommendations_stream',
+}
+
+# Streamed responses generate while the response is being sent, so these hold
+# a slot for the whole request instead
+STREAMING_ENDPOINTS = {
+    'api.api_recommendations_stream',
+    'api.form_recommendations_stream',
+}
+
+FORM_ENDPOINTS = {
+    'api.form_recommendations',
+    'api.form_recommendations_stream',
+}
+
+
+# Rate limits by API key when the client sends one, by address otherwise.
+# X-Client-Id is chosen by the client, so it isn't used here.
+def get_rate_limit_key():
+    return rate_limit_key(request.headers.get(Config.ADMISSION_API_KEY_HEADER), request.remote_addr)
+
+
+def rate_limit_key(api_key, remote_addr):
+    if api_key:
+        return 'key:' + hashlib.sha256(api_key.encode()).hexdigest()
+    return 'ip:' + (remote_addr or 'unknown')
+
+
+def rejection_message(rejected):
+    return "Too many requests" if rejected.status == 429 else "Server is busy"
+
+
+def rejection_response(rejected):
+    message = rejection_message(rejected)
+    headers = {'Retry-After': str(rejected.retry_after)}
+    if request.endpoint in FORM_ENDPOINTS:
+        error = f"{message}, please try again in {rejected.retry_after} seconds"
+        return render_template('recommendations.html', error=error), rejected.status, headers
+    return jsonify({"error": message, "reason": rejected.reason, "retry_after": rejected.retry_after}), rejected.status, headers
+
+
+def init_app(blueprint):
+    @blueprint.before_request
+    def admit_request():
+        if not Config.ADMISSION_ENABLED:
+            return None
+        try:
+            if request.endpoint in RATE_LIMITED_ENDPOINTS:
+                admission_controller.check_rate(get_rate_limit_key())
+            if request.endpoint in STREAMING_ENDPOINTS:
+                g.admission_token = admission_controller.acquire()
+        except AdmissionRejected as rejected:
+            return rejection_response(rejected)
+        return None
+
+    # Runs once a streamed response has finished too, so the slot covers the whole generation
+    @blueprint.teardown_request
+    def release_request(exception=None):
+        token = g.pop('admission_token', None)
+        if token is not None:
+            admission_controller.release(token)
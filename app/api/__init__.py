@@ -3,3 +3,6 @@ from flask import Blueprint
 api = Blueprint('api', __name__)
 
 from . import routes
+from app import admission
+
+admission.init_app(api)
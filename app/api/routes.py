@@ -1,7 +1,77 @@
 from . import api
-from flask import request, jsonify, render_template
-from app.recommendations import get_recommendations
+from flask import current_app, request, session, jsonify, render_template, Response, stream_template, stream_with_context
+from app.recommendation_pool import recommendation_pool
+from app.prefetch import page_prefetcher
+from app.recommendations import stream_recommendations
+from app.batch import iter_batch_results
+from app.admission import AdmissionRejected, get_rate_limit_key, rejection_response
+from app.metrics import span
+from config import Config
+import json
 import logging
+import uuid
+
+# Identifies the client's session so pooled and prefetched pages aren't
+# repeated to it or mixed up with another client's. Browsers get a session
+# cookie; API clients that don't keep cookies can send X-Client-Id, and are
+# keyed by address as a last resort.
+def get_client_id():
+    client_id = request.headers.get('X-Client-Id') or session.get('client_id')
+    if client_id:
+        return client_id
+    if request.is_json or not current_app.secret_key:
+        return request.remote_addr
+    client_id = session['client_id'] = uuid.uuid4().hex
+    return client_id
+
+# Returns the first page of a query, or the next page when the client asked
+# for more. The page after it is prefetched in the background either way.
+def get_page(movie, genres, moods, streaming_services, more_recommendations_flag):
+    query = (movie, genres, moods, streaming_services)
+    client_id = get_client_id()
+    if more_recommendations_flag:
+        return page_prefetcher.next_page(client_id, query)
+    recommendations = recommendation_pool.take(*query, client_id=client_id)
+    page_prefetcher.start(client_id, query, recommendations)
+    return recommendations
+
+# Records a streamed page once it has been sent, as get_page does for a
+# buffered one, so the client's "more" pages don't repeat it
+def record_page(client_id, query, recommendations):
+    if recommendations:
+        recommendation_pool.remember(*query, client_id=client_id, recommendations=recommendations)
+        page_prefetcher.start(client_id, query, recommendations)
+
+# Accepts JSON booleans as well as the form's "true"/"false" strings
+def parse_flag(value):
+    return value if isinstance(value, bool) else str(value).lower() == 'true'
+
+# Formats one Server-Sent Event
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Wraps a recommendation stream for stream_template. An error partway through
+# ends the loop and is kept in .error so the page can show it, like the SSE
+# route's error event, instead of being cut off. Whatever was shown is
+# recorded for the client when the stream ends.
+class RecommendationStream:
+    def __init__(self, recommendations, client_id, query):
+        self.recommendations = recommendations
+        self.client_id = client_id
+        self.query = query
+        self.shown = []
+        self.error = None
+
+    def __iter__(self):
+        try:
+            for recommendation in self.recommendations:
+                self.shown.append(recommendation)
+                yield recommendation
+        except Exception as e:
+            logging.error(f"Error: {str(e)}")
+            self.error = str(e)
+        finally:
+            record_page(self.client_id, self.query, self.shown)
 
 # Route for handling JSON API requests
 @api.route('/recommendations', methods=['POST'])
@@ -23,18 +93,21 @@ def api_recommendations():
         genres = data.get('genres', [])
         moods = data.get('moods', [])
         streaming_services = data.get('streaming_services', [])
-        more_recommendations_flag = data.get('moreRecommendationsFlag', 'false').lower() == 'true'
+        more_recommendations_flag = parse_flag(data.get('moreRecommendationsFlag', False))
 
         # Ensure all elements in lists are stripped of whitespace
         genres = [genre.strip() for genre in genres]
         moods = [mood.strip() for mood in moods]
         streaming_services = [service.strip() for service in streaming_services]
 
-        recommendations = get_recommendations(movie, genres, moods, streaming_services)
+        with span('recommend'):
+            recommendations = get_page(movie, genres, moods, streaming_services, more_recommendations_flag)
 
         logging.debug(f"Recommendations: {recommendations}")
         return jsonify({"recommendations": recommendations}), 200
 
+    except AdmissionRejected as rejected:
+        return rejection_response(rejected)
     except Exception as e:
         logging.error(f"Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -54,17 +127,117 @@ def form_recommendations():
         genres = data.get('genres', '')
         moods = data.get('moods', '')
         streaming_services = data.get('streaming_services', '')
-        more_recommendations_flag = data.get('moreRecommendationsFlag', 'false').lower() == 'true'
+        more_recommendations_flag = parse_flag(data.get('moreRecommendationsFlag', False))
 
         genres = [genre.strip() for genre in genres.split(",")] if genres else []
         moods = [mood.strip() for mood in moods.split(",")] if moods else []
         streaming_services = [service.strip() for service in streaming_services.split(",")] if streaming_services else []
 
-        recommendations = get_recommendations(movie, genres, moods, streaming_services) # always get new recommendations 
+        with span('recommend'):
+            recommendations = get_page(movie, genres, moods, streaming_services, more_recommendations_flag) # only recommendations this client hasn't seen yet
 
         logging.debug(f"Recommendations: {recommendations}")
-        return render_template('recommendations.html', recommendations=recommendations, movie=movie, genres=genres, moods=moods, streaming_services=streaming_services, more_recommendations=True)
+        with span('render'):
+            return render_template('recommendations.html', recommendations=recommendations, movie=movie, genres=genres, moods=moods, streaming_services=streaming_services, more_recommendations=True)
 
+    except AdmissionRejected as rejected:
+        return rejection_response(rejected)
     except Exception as e:
         logging.error(f"Error: {str(e)}")
         return render_template('recommendations.html', error=str(e))
+
+# Streaming variant of /recommendations: each recommendation is sent as an SSE
+# event as soon as it has been parsed and its poster looked up
+@api.route('/recommendations/stream', methods=['POST'])
+def api_recommendations_stream():
+    logging.debug("Accessed /api/recommendations/stream route")
+    if request.content_type != 'application/json':
+        logging.error(f"Unsupported Content-Type: {request.content_type}")
+        return jsonify({"error": "Content-Type must be application/json"}), 415
+
+    data = request.get_json()
+    if not data:
+        logging.error("No data received")
+        return jsonify({"error": "No data received"}), 400
+
+    movie = data.get('movie')
+    genres = [genre.strip() for genre in data.get('genres', [])]
+    moods = [mood.strip() for mood in data.get('moods', [])]
+    streaming_services = [service.strip() for service in data.get('streaming_services', [])]
+
+    query = (movie, genres, moods, streaming_services)
+    client_id = get_client_id()
+
+    def generate():
+        shown = []
+        try:
+            for recommendation in stream_recommendations(*query):
+                shown.append(recommendation)
+                yield sse_event('recommendation', recommendation)
+            yield sse_event('done', {})
+        except Exception as e:
+            logging.error(f"Error: {str(e)}")
+            yield sse_event('error', {"error": str(e)})
+        finally:
+            record_page(client_id, query, shown)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Progressive version of /form/recommendations: the page is streamed and each
+# recommendation is rendered as soon as it's ready
+@api.route('/form/recommendations/stream', methods=['POST'])
+def form_recommendations_stream():
+    logging.debug("Accessed /form/recommendations/stream route")
+    data = request.form.to_dict()
+    logging.debug(f'Received form data: {data}')
+
+    if not data:
+        return render_template('recommendations.html', error="No data received")
+
+    movie = data.get('movie')
+    genres = data.get('genres', '')
+    moods = data.get('moods', '')
+    streaming_services = data.get('streaming_services', '')
+
+    genres = [genre.strip() for genre in genres.split(",")] if genres else []
+    moods = [mood.strip() for mood in moods.split(",")] if moods else []
+    streaming_services = [service.strip() for service in streaming_services.split(",")] if streaming_services else []
+
+    query = (movie, genres, moods, streaming_services)
+    recommendations = RecommendationStream(stream_recommendations(*query), get_client_id(), query)
+    return Response(stream_template('recommendations.html', recommendations=recommendations, movie=movie, genres=genres, moods=moods, streaming_services=streaming_services, more_recommendations=True),
+                    headers={'X-Accel-Buffering': 'no'})
+
+# Route for getting recommendations for many queries in one request. Accepts
+# {"queries": [...]} (or a bare list) of /recommendations bodies. Results come
+# back in request order, or as NDJSON in completion order when the client
+# sends Accept: application/x-ndjson.
+@api.route('/recommendations/batch', methods=['POST'])
+def api_recommendations_batch():
+    logging.debug("Accessed /api/recommendations/batch route")
+    if request.content_type != 'application/json':
+        logging.error(f"Unsupported Content-Type: {request.content_type}")
+        return jsonify({"error": "Content-Type must be application/json"}), 415
+
+    data = request.get_json()
+    queries = data.get('queries') if isinstance(data, dict) else data
+    if not isinstance(queries, list) or not queries:
+        logging.error("No queries received")
+        return jsonify({"error": "Expected a non-empty list of queries"}), 400
+    if len(queries) > Config.BATCH_MAX_ITEMS:
+        return jsonify({"error": f"A batch can have at most {Config.BATCH_MAX_ITEMS} queries"}), 413
+
+    client_id = get_client_id()
+    rate_limit_key = get_rate_limit_key()
+
+    if request.accept_mimetypes.best == 'application/x-ndjson':
+        def generate():
+            for result in iter_batch_results(queries, client_id, rate_limit_key):
+                yield json.dumps(result) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                        headers={'X-Accel-Buffering': 'no'})
+
+    results = sorted(iter_batch_results(queries, client_id, rate_limit_key), key=lambda result: result['index'])
+    return jsonify({"results": results}), 200
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+
+from config import Config
+from app.admission import AdmissionRejected, admission_controller, rate_limit_key, rejection_message
+from app.api.routes import parse_flag
+from app.async_recommendations import async_clients, get_recommendations_coalesced_async
+from app.metrics import current_timings, render_metrics, request_seconds, server_timing_header
+
+# aiohttp front end for the recommendation routes. Each request is a coroutine
+# rather than a blocked worker, so one process can hold hundreds of in-flight
+# OpenAI/TMDB calls. The Flask app is still used for config, the database and
+# the Jinja templates.
+#
+# It's a reduced front end: only the first-page routes are served, always
+# generated (coalesced, but not from the recommendation pool), with no "more
+# recommendations" paging, streaming or batch routes. Those live in the WSGI
+# app (run.py), whose pool and prefetch layer run on threads.
+def create_async_app(flask_app):
+    app = web.Application(middlewares=[server_timing, admission])
+    app['flask_app'] = flask_app
+
+    async def start_clients(app):
+        await async_clients.start()
+
+    async def close_clients(app):
+        await async_clients.close()
+
+    app.on_startup.append(start_clients)
+    app.on_cleanup.append(close_clients)
+
+    app.router.add_get('/', home)
+    app.router.add_post('/api/recommendations', api_recommendations)
+    app.router.add_post('/api/form/recommendations', form_recommendations)
+    app.router.add_get('/metrics', metrics)
+    return app
+
+
+# Collects stage timings for the request and reports them in Server-Timing
+@web.middleware
+async def server_timing(request, handler):
+    timings = {}
+    token = current_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        response = await handler(request)
+    finally:
+        current_timings.reset(token)
+    total = time.perf_counter() - start
+    request_seconds.observe(total, request.path, response.status)
+    response.headers['Server-Timing'] = server_timing_header(timings, total)
+    return response
+
+
+# Same paths and form pages as the Flask admission hooks
+ADMITTED_PATHS = {'/api/recommendations', '/api/form/recommendations'}
+FORM_PATHS = {'/api/form/recommendations'}
+
+
+# Rate limits the recommendation routes with the shared admission controller
+# and turns shed generations (get_recommendations_async takes the slot) into
+# 429/503 responses with a Retry-After
+@web.middleware
+async def admission(request, handler):
+    if not Config.ADMISSION_ENABLED or request.path not in ADMITTED_PATHS:
+        return await handler(request)
+    try:
+        key = rate_limit_key(request.headers.get(Config.ADMISSION_API_KEY_HEADER), client_address(request))
+        await asyncio.get_running_loop().run_in_executor(None, admission_controller.check_rate, key)
+        return await handler(request)
+    except AdmissionRejected as rejected:
+        return rejection_response(request, rejected)
+
+
+# The client's address as reported by the PROXY_FIX_X_FOR trusted proxies,
+# like werkzeug's ProxyFix does for the Flask app
+def client_address(request):
+    if Config.PROXY_FIX_X_FOR:
+        forwarded = [value.strip() for value in ','.join(request.headers.getall('X-Forwarded-For', [])).split(',') if value.strip()]
+        if len(forwarded) >= Config.PROXY_FIX_X_FOR:
+            return forwarded[-Config.PROXY_FIX_X_FOR]
+    return request.remote
+
+
+def rejection_response(request, rejected):
+    message = rejection_message(rejected)
+    headers = {'Retry-After': str(rejected.retry_after)}
+    if request.path in FORM_PATHS:
+        response = render(request, 'recommendations.html', error=f"{message}, please try again in {rejected.retry_after} seconds")
+        response.set_status(rejected.status)
+        response.headers.update(headers)
+        return response
+    return web.json_response({"error": message, "reason": rejected.reason, "retry_after": rejected.retry_after},
+                             status=rejected.status, headers=headers)
+
+
+async def metrics(request):
+    return web.Response(text=render_metrics(), content_type='text/plain')
+
+
+def render(request, template_name, **context):
+    flask_app = request.app['flask_app']
+    with flask_app.app_context():
+        text = flask_app.jinja_env.get_template(template_name).render(**context)
+    return web.Response(text=text, content_type='text/html')
+
+
+MORE_UNSUPPORTED = "More recommendations aren't available from this server; start a new search"
+
+
+async def home(request):
+    logging.debug("Accessed home route")
+    return render(request, 'form.html')
+
+
+async def api_recommendations(request):
+    logging.debug("Accessed /api/recommendations route")
+    try:
+        if request.content_type != 'application/json':
+            logging.error(f"Unsupported Content-Type: {request.content_type}")
+            return web.json_response({"error": "Content-Type must be application/json"}, status=415)
+
+        data = await request.json()
+        logging.debug(f'Parsed JSON data: {data}')
+
+        if not data:
+            logging.error("No data received")
+            return web.json_response({"error": "No data received"}, status=400)
+
+        movie = data.get('movie')
+        genres = [genre.strip() for genre in data.get('genres', [])]
+        moods = [mood.strip() for mood in data.get('moods', [])]
+        streaming_services = [service.strip() for service in data.get('streaming_services', [])]
+        if parse_flag(data.get('moreRecommendationsFlag', False)):
+            return web.json_response({"error": MORE_UNSUPPORTED}, status=501)
+
+        recommendations = await get_recommendations_coalesced_async(movie, genres, moods, streaming_services)
+
+        logging.debug(f"Recommendations: {recommendations}")
+        return web.json_response({"recommendations": recommendations})
+
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logging.error(f"Error: {str(e)}")
+        return web.json_response({"error": str(e)}, status=500)
+
+
+async def form_recommendations(request):
+    logging.debug("Accessed /form/recommendations route")
+    try:
+        data = dict(await request.post())
+        logging.debug(f'Received form data: {data}')
+
+        if not data:
+            return render(request, 'recommendations.html', error="No data received")
+
+        movie = data.get('movie')
+        genres = data.get('genres', '')
+        moods = data.get('moods', '')
+        streaming_services = data.get('streaming_services', '')
+
+        genres = [genre.strip() for genre in genres.split(",")] if genres else []
+        moods = [mood.strip() for mood in moods.split(",")] if moods else []
+        streaming_services = [service.strip() for service in streaming_services.split(",")] if streaming_services else []
+        if parse_flag(data.get('moreRecommendationsFlag', False)):
+            return render(request, 'recommendations.html', error=MORE_UNSUPPORTED)
+
+        recommendations = await get_recommendations_coalesced_async(movie, genres, moods, streaming_services)
+
+        logging.debug(f"Recommendations: {recommendations}")
+        return render(request, 'recommendations.html', recommendations=recommendations, movie=movie, genres=genres, moods=moods, streaming_services=streaming_services, more_recommendations=False)
+
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logging.error(f"Error: {str(e)}")
+        return render(request, 'recommendations.html', error=str(e))
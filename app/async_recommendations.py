@@ -0,0 +1,216 @@
+import asyncio
+import logging
+
+import aiohttp
+import openai
+
+from config import Config
+from app.poster_cache import poster_cache
+from app.singleflight import AsyncSingleFlight, SingleFlightError
+from app.recommendation_pool import make_query_key
+from app.metrics import span, upstream_calls, parse_failures
+from app.upstream import Upstream, UpstreamError
+from app.admission import admission_controller
+from app.recommendations import (
+    build_prompt, build_rerank_prompt, collect_recommendations,
+    finish_usage, get_catalog_candidates, new_usage, parse_function_call, parse_rerank_reply, recommendation_function,
+    poster_url_from_search, record_usage, tmdb_access_token, tmdb_search_params,
+)
+
+# Non-blocking version of the recommendation pipeline. One shared aiohttp
+# session (and its connection pool) is used for both OpenAI and TMDB calls.
+class AsyncClients:
+    def __init__(self):
+        self.session = None
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=Config.ASYNC_HTTP_POOL_SIZE)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+async_clients = AsyncClients()
+
+# Same rule as is_retryable_tmdb_error: only 5xx and 429 responses are retried
+def is_retryable_tmdb_error_async(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return True
+
+# Async counterparts of the upstream call layer in recommendations.py
+openai_upstream = Upstream(
+    'openai_async', deadline=Config.OPENAI_DEADLINE, retries=Config.OPENAI_RETRIES,
+    retryable=(openai.error.Timeout, openai.error.APIConnectionError, openai.error.ServiceUnavailableError, openai.error.APIError),
+    hedge=Config.OPENAI_HEDGE, hedge_percentile=Config.UPSTREAM_HEDGE_PERCENTILE, hedge_default_delay=Config.OPENAI_HEDGE_DELAY,
+    failure_threshold=Config.UPSTREAM_BREAKER_FAILURES, reset_timeout=Config.UPSTREAM_BREAKER_RESET,
+)
+tmdb_upstream = Upstream(
+    'tmdb_async', deadline=Config.TMDB_DEADLINE, retries=Config.TMDB_RETRIES,
+    retryable=(aiohttp.ClientError, asyncio.TimeoutError),
+    retry_if=is_retryable_tmdb_error_async,
+    hedge=Config.TMDB_HEDGE, hedge_percentile=Config.UPSTREAM_HEDGE_PERCENTILE, hedge_default_delay=Config.TMDB_HEDGE_DELAY,
+    failure_threshold=Config.UPSTREAM_BREAKER_FAILURES, reset_timeout=Config.UPSTREAM_BREAKER_RESET,
+)
+
+# Identical in-flight poster lookups and recommendation queries share one call
+poster_flights = AsyncSingleFlight('posters', timeout=Config.TMDB_DEADLINE)
+recommendation_flights = AsyncSingleFlight('recommendations')
+
+
+# Async version of chat_completion
+async def chat_completion_async(prompt, usage=None, kind='generate', **kwargs):
+    try:
+        openai.aiosession.set(await async_clients.start())
+        logging.debug(f"Sending prompt to OpenAI API: {prompt}")
+
+        async def request():
+            try:
+                response = await openai.ChatCompletion.acreate(
+                    model="gpt-3.5-turbo",
+                    messages=[{"role": "user", "content": prompt}],
+                    request_timeout=Config.OPENAI_TIMEOUT,
+                    **kwargs
+                )
+            except openai.error.OpenAIError:
+                upstream_calls.inc('openai', 'error')
+                raise
+            upstream_calls.inc('openai', 'ok')
+            return response
+
+        with span('openai'):
+            response = await openai_upstream.call_async(request, kind=kind)
+        logging.debug("Received response from OpenAI API")
+        record_usage(usage, response)
+        return response.choices[0].message
+    except (openai.error.OpenAIError, UpstreamError) as e:
+        logging.error(f"OpenAI API error: {e}")
+        raise
+
+
+async def fetch_poster_from_tmdb_async(title, year=None):
+    session = await async_clients.start()
+
+    async def search(year):
+        async def request():
+            try:
+                async with session.get(
+                    f'{Config.TMDB_API_URL}/search/movie',
+                    params=tmdb_search_params(title, year),
+                    headers={'Authorization': f'Bearer {tmdb_access_token}'},
+                    timeout=aiohttp.ClientTimeout(total=Config.TMDB_TIMEOUT),
+                ) as response:
+                    response.raise_for_status()
+                    data = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                upstream_calls.inc('tmdb', 'error')
+                raise
+            upstream_calls.inc('tmdb', 'ok')
+            return data
+
+        return poster_url_from_search(await tmdb_upstream.call_async(request))
+
+    poster_url = await search(year)
+    if poster_url is None and 'year' in tmdb_search_params(title, year):
+        # Same title-only fallback as fetch_poster_from_tmdb
+        poster_url = await search(None)
+    return poster_url
+
+
+# Async version of get_poster_from_tmdb. The cache's database tier is
+# synchronous, so it's consulted from the default executor.
+async def get_poster_async(title, year=None):
+    loop = asyncio.get_running_loop()
+    found, poster_url = await loop.run_in_executor(None, poster_cache.get, title, year)
+    if found:
+        return poster_url
+
+    async def fetch():
+        poster_url = await fetch_poster_from_tmdb_async(title, year)
+        await loop.run_in_executor(None, poster_cache.set, title, year, poster_url)
+        return poster_url
+
+    try:
+        return await poster_flights.do(poster_cache.make_key(title, year), fetch)
+    except (aiohttp.ClientError, asyncio.TimeoutError, SingleFlightError, UpstreamError) as e:
+        logging.error(f"TMDB API error: {e}")
+        return None
+
+
+# Async version of add_posters: all lookups run at once under one deadline
+async def add_posters_async(recommendations):
+    missing = [rec for rec in recommendations if 'poster_url' not in rec]
+    tasks = [asyncio.ensure_future(get_poster_async(rec['title'], rec.get('year'))) for rec in missing]
+    if not tasks:
+        return recommendations
+    done, pending = await asyncio.wait(tasks, timeout=Config.TMDB_DEADLINE)
+
+    for rec, task in zip(missing, tasks):
+        if task in pending:
+            task.cancel()
+            logging.warning(f"Poster lookup timed out for: {rec['title']}")
+        elif task.exception() is not None:
+            logging.error(f"Unexpected error getting poster: {task.exception()}")
+        elif task.result():
+            rec['poster_url'] = task.result()
+
+    return recommendations
+
+
+# Async version of get_catalog_recommendations
+async def get_catalog_recommendations_async(movie=None, genres=None, moods=None, streaming_services=None, exclude=None, usage=None, count=3):
+    candidates = get_catalog_candidates(movie, genres, streaming_services, exclude, count)
+    if not candidates:
+        return []
+    try:
+        message = await chat_completion_async(build_rerank_prompt(movie, genres, moods, candidates, count), usage, kind='rerank')
+    except Exception as e:
+        logging.error(f"Catalog re-rank failed, generating instead: {e}")
+        return []
+    return parse_rerank_reply(message.get('content') or '', candidates, movie, streaming_services, count)
+
+
+# Async version of get_recommendations, with the same call cap and top-up rules
+async def get_recommendations_async(movie=None, genres=None, moods=None, streaming_services=None, exclude=None, usage=None, count=3):
+    async with admission_controller.slot_async():
+        usage = new_usage() if usage is None else usage
+        structured = Config.RECOMMENDATIONS_MODE == 'json'
+        require_similarity = bool(movie)
+        excluded = list(exclude or [])
+
+        parsed_recommendations = await get_catalog_recommendations_async(movie, genres, moods, streaming_services, excluded, usage, count)
+        excluded.extend(rec['title'] for rec in parsed_recommendations)
+
+        while len(parsed_recommendations) < count and usage['model_calls'] < Config.RECOMMENDATIONS_MAX_MODEL_CALLS:
+            prompt = build_prompt(movie, genres, moods, streaming_services, count=count - len(parsed_recommendations), exclude=excluded, structured=structured)
+
+            try:
+                if structured:
+                    message = await chat_completion_async(prompt, usage, functions=[recommendation_function(require_similarity)], function_call={"name": "recommend_movies"})
+                    recommendations_list = parse_function_call(message)
+                else:
+                    message = await chat_completion_async(prompt, usage)
+                    recommendations_list = (message.get('content') or '').strip().split('\n\n')
+            except ValueError as e:
+                parse_failures.inc('malformed_response')
+                logging.error(f"Skipping response due to error: {e}")
+                continue
+
+            collect_recommendations(recommendations_list, parsed_recommendations, excluded, count, structured, require_similarity)
+
+        finish_usage(usage, parsed_recommendations)
+
+        with span('tmdb'):
+            return await add_posters_async(parsed_recommendations)
+
+
+# Coalesced entry point used by the async routes
+async def get_recommendations_coalesced_async(movie=None, genres=None, moods=None, streaming_services=None):
+    key = repr(make_query_key(movie, genres, moods, streaming_services))
+    recommendations = await recommendation_flights.do(key, lambda: get_recommendations_async(movie, genres, moods, streaming_services))
+    return [dict(rec) for rec in recommendations]
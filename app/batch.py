@@ -0,0 +1,55 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from config import Config
+from app.recommendation_pool import recommendation_pool
+from app.admission import AdmissionRejected, admission_controller, rejection_message
+
+# Reads one batch item into (movie, genres, moods, streaming_services)
+def parse_batch_item(item):
+    if not isinstance(item, dict):
+        raise ValueError("Each query must be an object")
+    movie = item.get('movie')
+    genres = [genre.strip() for genre in item.get('genres', [])]
+    moods = [mood.strip() for mood in item.get('moods', [])]
+    streaming_services = [service.strip() for service in item.get('streaming_services', [])]
+    return movie, genres, moods, streaming_services
+
+def run_batch_item(item, client_id):
+    movie, genres, moods, streaming_services = parse_batch_item(item)
+    return recommendation_pool.take(movie, genres, moods, streaming_services, client_id=client_id)
+
+# Runs the queries concurrently (at most BATCH_MAX_CONCURRENCY at a time) and
+# yields one result per query as it completes. Each query takes its own token
+# from rate_limit_key's bucket up front and its own admission slot while it
+# generates. A failed or rejected query yields an error entry instead of
+# failing the batch. Overlapping items share poster lookups through the
+# poster cache and single-flight layer.
+def iter_batch_results(queries, client_id=None, rate_limit_key=None, concurrency=None):
+    concurrency = max(1, min(concurrency or Config.BATCH_MAX_CONCURRENCY, len(queries) or 1))
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch')
+    try:
+        futures = {}
+        for index, item in enumerate(queries):
+            try:
+                if rate_limit_key is not None:
+                    admission_controller.check_rate(rate_limit_key)
+            except AdmissionRejected as rejected:
+                yield batch_error(index, rejected)
+                continue
+            futures[executor.submit(run_batch_item, item, client_id)] = index
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                yield {"index": index, "recommendations": future.result()}
+            except Exception as e:
+                logging.error(f"Error in batch item {index}: {e}")
+                yield batch_error(index, e)
+    finally:
+        # Drops queued items if the client went away mid-stream
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def batch_error(index, error):
+    if isinstance(error, AdmissionRejected):
+        return {"index": index, "error": rejection_message(error), "reason": error.reason, "retry_after": error.retry_after}
+    return {"index": index, "error": str(error)}
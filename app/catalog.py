@@ -0,0 +1,248 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+import click
+from sqlalchemy.exc import SQLAlchemyError
+
+from config import Config
+
+# TMDB genre names that differ from the genre buttons on the form
+GENRE_ALIASES = {
+    'science fiction': 'sci-fi',
+    'thriller': 'thriller/suspense',
+    'suspense': 'thriller/suspense',
+    'music': 'musical',
+}
+
+# TMDB watch provider names mapped to the streaming service buttons on the form
+SERVICE_ALIASES = {
+    'amazon prime video': 'amazon prime',
+    'amazon video': 'amazon prime',
+    'prime video': 'amazon prime',
+    'hbo max': 'hbo',
+    'max': 'hbo',
+    'hbo now': 'hbo',
+    'netflix basic with ads': 'netflix',
+}
+
+
+def normalize_genre(name):
+    name = ' '.join(name.lower().split())
+    return GENRE_ALIASES.get(name, name)
+
+
+def normalize_service(name):
+    name = ' '.join(name.lower().split())
+    return SERVICE_ALIASES.get(name, name)
+
+
+def split_values(value):
+    return [part for part in (value or '').split(',') if part]
+
+
+# Converts one TMDB movie details object (optionally with watch/providers
+# appended) into Movie column values
+def movie_from_tmdb(data, region=None):
+    region = region or Config.CATALOG_WATCH_REGION
+    genres = {normalize_genre(genre['name'] if isinstance(genre, dict) else genre) for genre in data.get('genres') or []}
+    if 'romance' in genres and 'comedy' in genres:
+        genres.add('romantic comedy')
+
+    providers = ((data.get('watch/providers') or {}).get('results') or {}).get(region) or {}
+    services = {normalize_service(provider['provider_name']) for provider in providers.get('flatrate') or []}
+
+    release_date = data.get('release_date') or ''
+    return {
+        'tmdb_id': data['id'],
+        'title': data.get('title') or data.get('original_title') or '',
+        'year': int(release_date[:4]) if release_date[:4].isdigit() else None,
+        'runtime': data.get('runtime') or None,
+        'genres': ','.join(sorted(genres)),
+        'streaming_services': ','.join(sorted(services)),
+        'overview': data.get('overview') or '',
+        'poster_path': data.get('poster_path'),
+        'imdb_id': data.get('imdb_id') or (data.get('external_ids') or {}).get('imdb_id'),
+        'popularity': data.get('popularity') or 0,
+        'vote_average': data.get('vote_average'),
+    }
+
+
+# Reads a dump: either a JSON array or one JSON object per line
+def iter_dump(file):
+    first = file.read(1)
+    file.seek(0)
+    if first == '[':
+        yield from json.load(file)
+        return
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+# In-memory inverted indexes over the movie table, so candidate sets for a
+# query can be picked without touching the database or TMDB
+class MovieCatalog:
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loaded = False
+        self.retry_at = 0
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.cli.add_command(catalog_cli)
+
+    def reset(self):
+        self.movies = {}
+        self.by_title = {}
+        self.by_genre = defaultdict(set)
+        self.by_service = defaultdict(set)
+
+    def add(self, movie):
+        self.movies[movie['tmdb_id']] = movie
+        self.by_title[movie['title'].lower()] = movie['tmdb_id']
+        for genre in movie['genres']:
+            self.by_genre[genre].add(movie['tmdb_id'])
+        for service in movie['streaming_services']:
+            self.by_service[service].add(movie['tmdb_id'])
+
+    # Returns whether the movie table could be read
+    def load(self):
+        if self.app is None:
+            return False
+        from .models import Movie
+        try:
+            with self.app.app_context():
+                rows = Movie.query.all()
+                movies = [{
+                    'tmdb_id': row.tmdb_id,
+                    'title': row.title,
+                    'year': row.year,
+                    'runtime': row.runtime,
+                    'genres': split_values(row.genres),
+                    'streaming_services': split_values(row.streaming_services),
+                    'overview': row.overview or '',
+                    'poster_path': row.poster_path,
+                    'imdb_id': row.imdb_id,
+                    'popularity': row.popularity or 0,
+                } for row in rows]
+        except SQLAlchemyError as e:
+            logging.error(f"Could not load movie catalog: {e}")
+            return False
+        with self.lock:
+            self.reset()
+            for movie in movies:
+                self.add(movie)
+            self.loaded = True
+        logging.info(f"Loaded {len(movies)} movies into the catalog indexes")
+        return True
+
+    # Loads the catalog on first use. Concurrent first requests wait for a
+    # single load, and a failed load (e.g. the movie table is missing) is not
+    # retried for CATALOG_RETRY_SECONDS, so requests fall back to GPT-only
+    # recommendations instead of each re-reading the table.
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        with self.load_lock:
+            if self.loaded or time.monotonic() < self.retry_at:
+                return
+            if not self.load():
+                self.retry_at = time.monotonic() + Config.CATALOG_RETRY_SECONDS
+
+    def find(self, title):
+        self.ensure_loaded()
+        tmdb_id = self.by_title.get(' '.join((title or '').lower().split()))
+        return self.movies.get(tmdb_id)
+
+    # Returns up to limit movies matching any of the genres and any of the
+    # services, most popular first. When no genres are asked for, the seed
+    # movie's genres are used instead.
+    def candidates(self, movie=None, genres=None, streaming_services=None, exclude=None, limit=None):
+        self.ensure_loaded()
+        limit = limit or Config.CATALOG_MAX_CANDIDATES
+        seed = self.find(movie) if movie else None
+
+        genres = [normalize_genre(genre) for genre in genres or []] or (seed['genres'] if seed else [])
+        services = [normalize_service(service) for service in streaming_services or []]
+
+        with self.lock:
+            filters = []
+            if genres:
+                filters.append(set().union(*(self.by_genre.get(genre, set()) for genre in genres)))
+            if services:
+                filters.append(set().union(*(self.by_service.get(service, set()) for service in services)))
+            if not filters:
+                return []
+
+            ids = set.intersection(*filters)
+            excluded = {title.lower() for title in exclude or []}
+            if seed:
+                excluded.add(seed['title'].lower())
+            matches = [self.movies[tmdb_id] for tmdb_id in ids if self.movies[tmdb_id]['title'].lower() not in excluded]
+
+        matches.sort(key=lambda movie: movie['popularity'], reverse=True)
+        return matches[:limit]
+
+    def import_dump(self, file, region=None, batch_size=500):
+        from .models import Movie
+        from . import db
+        imported = 0
+        with self.app.app_context():
+            existing = {row.tmdb_id: row for row in Movie.query.all()}
+            for data in iter_dump(file):
+                try:
+                    values = movie_from_tmdb(data, region)
+                except (KeyError, TypeError) as e:
+                    logging.error(f"Skipping malformed catalog entry: {e}")
+                    continue
+                row = existing.get(values['tmdb_id'])
+                if row is None:
+                    row = existing[values['tmdb_id']] = Movie()
+                    db.session.add(row)
+                for key, value in values.items():
+                    setattr(row, key, value)
+                imported += 1
+                if imported % batch_size == 0:
+                    db.session.commit()
+            db.session.commit()
+        self.load()
+        return imported
+
+    def stats(self):
+        with self.lock:
+            return {
+                'movies': len(self.movies),
+                'genres': len(self.by_genre),
+                'services': len(self.by_service),
+            }
+
+
+movie_catalog = MovieCatalog()
+
+
+@click.group('catalog', help='Manage the local movie catalog.')
+def catalog_cli():
+    pass
+
+
+@catalog_cli.command('import')
+@click.argument('dump', type=click.File('r'))
+@click.option('--region', default=None, help='Watch provider region to read (default CATALOG_WATCH_REGION).')
+def catalog_import(dump, region):
+    click.echo(f"Imported {movie_catalog.import_dump(dump, region)} movie(s)")
+
+
+@catalog_cli.command('stats')
+def catalog_stats():
+    movie_catalog.load()
+    for name, value in movie_catalog.stats().items():
+        click.echo(f"{name}: {value}")
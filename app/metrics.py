@@ -0,0 +1,167 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+# Minimal Prometheus-format metrics plus per-request stage timings for the
+# Server-Timing header. Metrics are kept per process.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = []
+
+
+def format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [bucket counts..., count, sum]
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, series in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, [('le', '+Inf')])} {series[-2]}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {series[-2]}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+# Exposes the stats() dict of a component (cache, pool, ...) as a gauge
+class StatsGauge:
+    def __init__(self, name, help, stats_fn):
+        self.name = name
+        self.help = help
+        self.stats_fn = stats_fn
+        registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.stats_fn().items()):
+            lines.append(f'{self.name}{{stat="{key}"}} {value}')
+        return lines
+
+
+# Registers a StatsGauge once, however many times create_app runs
+def register_stats(name, help, stats_fn):
+    if not any(metric.name == name for metric in registry):
+        StatsGauge(name, help, stats_fn)
+
+
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+stage_seconds = Histogram('watchbuddy_stage_seconds', 'Time spent in each recommendation stage.', ['stage'])
+request_seconds = Histogram('watchbuddy_request_seconds', 'Request latency by endpoint.', ['endpoint', 'status'])
+upstream_calls = Counter('watchbuddy_upstream_calls_total', 'Calls made to upstream APIs.', ['upstream', 'outcome'])
+model_retries = Counter('watchbuddy_model_retries_total', 'Extra model calls made to top up a recommendation request.')
+parse_failures = Counter('watchbuddy_parse_failures_total', 'Recommendation blocks rejected by the parser.', ['reason'])
+request_model_calls = Histogram('watchbuddy_request_model_calls', 'Model calls made to generate one set of recommendations.', buckets=(1, 2, 3, 4, 5, 10))
+request_tokens = Histogram('watchbuddy_request_tokens', 'Tokens used to generate one set of recommendations.', ['kind'], buckets=(100, 250, 500, 1000, 2000, 4000, 8000))
+
+# Stage durations of the current request, for the Server-Timing header
+current_timings = contextvars.ContextVar('current_timings', default=None)
+
+
+# Times a stage: observed in the stage histogram and added to the current
+# request's Server-Timing breakdown (repeated stages are summed)
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage)
+        timings = current_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def server_timing_header(timings, total=None):
+    entries = [f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in timings.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ', '.join(entries)
+
+
+def init_app(app):
+    @app.before_request
+    def start_timing():
+        g.request_start = time.perf_counter()
+        g.timings = {}
+        g.timings_token = current_timings.set(g.timings)
+
+    @app.after_request
+    def add_server_timing(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        request_seconds.observe(total, request.endpoint or 'unknown', response.status_code)
+        response.headers['Server-Timing'] = server_timing_header(g.timings, total)
+        return response
+
+    @app.teardown_request
+    def reset_timing(exception=None):
+        token = g.pop('timings_token', None)
+        if token is not None:
+            try:
+                current_timings.reset(token)
+            except ValueError:
+                current_timings.set(None)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -1,5 +1,4 @@
-# not using a database (yet)
-
+from datetime import datetime
 from . import db
 
 class User(db.Model):
@@ -9,4 +8,36 @@ class User(db.Model):
     password_hash = db.Column(db.String(128))
 
     def __repr__(self):
-        return f'<User {self.username}'
\ No newline at end of file
+        return f'<User {self.username}'
+
+# Cached TMDB poster lookups. A null poster_url records that TMDB had no poster.
+class PosterCacheEntry(db.Model):
+    __tablename__ = 'poster_cache'
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(320), index=True, unique=True)
+    title = db.Column(db.String(256))
+    year = db.Column(db.String(16))
+    poster_url = db.Column(db.String(512), nullable=True)
+    fetched_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<PosterCacheEntry {self.cache_key}>'
+
+# Local movie catalog, bulk imported from TMDB-format dumps ('flask catalog import').
+# genres and streaming_services are comma-separated, normalized to the form's values.
+class Movie(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    tmdb_id = db.Column(db.Integer, index=True, unique=True)
+    title = db.Column(db.String(256), index=True)
+    year = db.Column(db.Integer, index=True, nullable=True)
+    runtime = db.Column(db.Integer, nullable=True)
+    genres = db.Column(db.String(256), default='')
+    streaming_services = db.Column(db.String(256), default='')
+    overview = db.Column(db.Text, default='')
+    poster_path = db.Column(db.String(256), nullable=True)
+    imdb_id = db.Column(db.String(16), nullable=True)
+    popularity = db.Column(db.Float, default=0)
+    vote_average = db.Column(db.Float, nullable=True)
+
+    def __repr__(self):
+        return f'<Movie {self.title} ({self.year})>'
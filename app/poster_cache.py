@@ -0,0 +1,203 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy.exc import SQLAlchemyError
+
+from config import Config
+
+# Two-tier cache for TMDB poster lookups: a bounded in-process LRU in front of
+# the poster_cache table. Negative results ("no poster found") are cached too,
+# with a shorter TTL. Memory entries are only trusted for MEMORY_TTL before the
+# row is read again, so 'flask posters invalidate' (which runs in its own
+# process) reaches every worker within that time.
+class PosterCache:
+    def __init__(self, app=None):
+        self.app = None
+        self.max_size = Config.POSTER_CACHE_SIZE
+        self.ttl = Config.POSTER_CACHE_TTL
+        self.negative_ttl = Config.POSTER_CACHE_NEGATIVE_TTL
+        self.memory_ttl = Config.POSTER_CACHE_MEMORY_TTL
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {
+            'memory_hits': 0,
+            'db_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'negative_hits': 0,
+        }
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_size = app.config.get('POSTER_CACHE_SIZE', self.max_size)
+        self.ttl = app.config.get('POSTER_CACHE_TTL', self.ttl)
+        self.negative_ttl = app.config.get('POSTER_CACHE_NEGATIVE_TTL', self.negative_ttl)
+        self.memory_ttl = app.config.get('POSTER_CACHE_MEMORY_TTL', self.memory_ttl)
+        app.cli.add_command(posters_cli)
+
+    @staticmethod
+    def make_key(title, year=None):
+        return f"{' '.join(title.lower().split())}|{str(year or '').strip()}"
+
+    def _ttl_for(self, poster_url):
+        return self.ttl if poster_url else self.negative_ttl
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    # Keeps an entry in memory for expires_in seconds, at most memory_ttl
+    def _remember(self, key, poster_url, expires_in):
+        expires_at = time.time() + min(expires_in, self.memory_ttl)
+        with self.lock:
+            self.entries[key] = (poster_url, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    # Returns (found, poster_url). poster_url is None for cached negatives.
+    def get(self, title, year=None):
+        key = self.make_key(title, year)
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                if entry[0] is None:
+                    self.counters['negative_hits'] += 1
+                return True, entry[0]
+            if entry:
+                del self.entries[key]
+
+        row = self._get_row(key)
+        if row is not None:
+            expires_at = row.fetched_at + timedelta(seconds=self._ttl_for(row.poster_url))
+            if expires_at > datetime.utcnow():
+                self._remember(key, row.poster_url, (expires_at - datetime.utcnow()).total_seconds())
+                self._count('db_hits')
+                if row.poster_url is None:
+                    self._count('negative_hits')
+                return True, row.poster_url
+
+        self._count('misses')
+        return False, None
+
+    def set(self, title, year, poster_url):
+        key = self.make_key(title, year)
+        self._remember(key, poster_url, self._ttl_for(poster_url))
+        if self.app is None:
+            return
+        from .models import PosterCacheEntry
+        from . import db
+        try:
+            with self.app.app_context():
+                row = PosterCacheEntry.query.filter_by(cache_key=key).first()
+                if row is None:
+                    row = PosterCacheEntry(cache_key=key)
+                    db.session.add(row)
+                row.title = title
+                row.year = str(year or '')
+                row.poster_url = poster_url
+                row.fetched_at = datetime.utcnow()
+                db.session.commit()
+        except SQLAlchemyError as e:
+            logging.error(f"Poster cache write failed for {key}: {e}")
+
+    def _get_row(self, key):
+        if self.app is None:
+            return None
+        from .models import PosterCacheEntry
+        try:
+            with self.app.app_context():
+                return PosterCacheEntry.query.filter_by(cache_key=key).first()
+        except SQLAlchemyError as e:
+            logging.error(f"Poster cache read failed for {key}: {e}")
+            return None
+
+    # Drops one title (or every entry when title is None) from both tiers
+    def invalidate(self, title=None, year=None):
+        from .models import PosterCacheEntry
+        from . import db
+        with self.lock:
+            if title is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(self.make_key(title, year), None)
+        if self.app is None:
+            return 0
+        with self.app.app_context():
+            query = PosterCacheEntry.query
+            if title is not None:
+                query = query.filter_by(cache_key=self.make_key(title, year))
+            removed = query.delete()
+            db.session.commit()
+            return removed
+
+    # Looks up titles that aren't cached yet so they're ready before traffic hits
+    def warm(self, titles, fetch):
+        warmed = 0
+        for title, year in titles:
+            found, _ = self.get(title, year)
+            if found:
+                continue
+            try:
+                self.set(title, year, fetch(title, year))
+                warmed += 1
+            except Exception as e:
+                logging.error(f"Could not warm poster for {title}: {e}")
+        return warmed
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.entries)
+        return stats
+
+
+poster_cache = PosterCache()
+
+
+@click.group('posters', help='Manage the TMDB poster cache.')
+def posters_cli():
+    pass
+
+
+# Reports the shared table. Hit and miss counters are per worker process, so
+# they're exported on each worker's /metrics instead.
+@posters_cli.command('stats')
+def posters_stats():
+    from .models import PosterCacheEntry
+    click.echo(f"entries: {PosterCacheEntry.query.count()}")
+    click.echo(f"negative: {PosterCacheEntry.query.filter(PosterCacheEntry.poster_url.is_(None)).count()}")
+
+
+@posters_cli.command('warm')
+@click.argument('titles', nargs=-1)
+@click.option('--file', 'titles_file', type=click.File('r'), help='File with one "title|year" per line.')
+def posters_warm(titles, titles_file):
+    from .recommendations import fetch_poster_from_tmdb
+    entries = list(titles)
+    if titles_file:
+        entries.extend(line.strip() for line in titles_file if line.strip())
+    parsed = [tuple(entry.split('|', 1)) if '|' in entry else (entry, None) for entry in entries]
+    click.echo(f"Warmed {poster_cache.warm(parsed, fetch_poster_from_tmdb)} poster(s)")
+
+
+@posters_cli.command('invalidate')
+@click.argument('title', required=False)
+@click.option('--year', default=None)
+@click.option('--all', 'invalidate_all', is_flag=True, help='Drop every cached poster.')
+def posters_invalidate(title, year, invalidate_all):
+    if not title and not invalidate_all:
+        raise click.UsageError('Pass a title or --all')
+    removed = poster_cache.invalidate(None if invalidate_all else title, year)
+    click.echo(f"Removed {removed} cached poster(s); running workers drop their copies within {poster_cache.memory_ttl}s")
@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from config import Config
+from app.recommendation_pool import make_query_key, recommendation_pool
+from app.recommendations import get_recommendations
+from app.admission import AdmissionRejected
+
+
+class PrefetchSession:
+    def __init__(self, client_id, query, max_shown):
+        self.client_id = client_id
+        self.query = query
+        self.key = make_query_key(*query)
+        self.shown = []
+        self.max_shown = max_shown
+        self.future = None
+        self.last_used = time.time()
+
+    def add_shown(self, recommendations):
+        self.shown.extend(rec['title'] for rec in recommendations)
+        del self.shown[:-self.max_shown]
+
+    # Only stops a prefetch that hasn't started; one that has keeps running
+    # and still adds its page to the query's pool
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+
+
+# Serves the "more recommendations" pages of a client's session. Unseen titles
+# in the query's recommendation pool are used first; the next page is only
+# generated in the background when the pool can't cover it (and no refill is
+# on its way), and whatever is generated goes into the pool as well, so a
+# prefetch the client doesn't come back for isn't wasted. Sessions are keyed
+# by client, capped in number and in remembered titles, and expire when the
+# client doesn't come back.
+class PagePrefetcher:
+    def __init__(self):
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = None
+        self.counters = {'prefetched': 0, 'pool_hits': 0, 'hits': 0, 'waits': 0, 'misses': 0, 'expired': 0, 'skipped': 0, 'errors': 0}
+
+    def _get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=Config.PREFETCH_WORKERS, thread_name_prefix='prefetch')
+        return self.executor
+
+    # Drops expired sessions and the oldest ones over the limit. Caller holds the lock.
+    def _evict(self):
+        now = time.time()
+        for client_id in [client_id for client_id, session in self.sessions.items() if now - session.last_used > Config.PREFETCH_TTL]:
+            self.sessions.pop(client_id).cancel()
+            self.counters['expired'] += 1
+        while len(self.sessions) > Config.PREFETCH_MAX_SESSIONS:
+            self.sessions.popitem(last=False)[1].cancel()
+            self.counters['expired'] += 1
+
+    # Skipped (returns None) when no admission slot is free, leaving the next
+    # page to the pool or to the request itself
+    def _prefetch(self, query, exclude):
+        try:
+            recommendations = get_recommendations(*query, exclude=exclude, background=True)
+        except AdmissionRejected:
+            with self.lock:
+                self.counters['skipped'] += 1
+            return None
+        recommendation_pool.remember(*query, recommendations=recommendations)
+        return recommendations
+
+    # Starts generating the session's next page unless one is already on its
+    # way or the pool can cover it. Caller holds the lock.
+    def _schedule(self, session, count=3):
+        future = session.future
+        if future is not None and not future.cancelled():
+            if not future.done() or not recommendation_pool.enabled:
+                return
+            # Its page went into the pool, which is checked below
+            session.future = None
+        if recommendation_pool.has_next_page(*session.query, client_id=session.client_id, count=count):
+            return
+        session.future = self._get_executor().submit(self._prefetch, session.query, list(session.shown))
+        self.counters['prefetched'] += 1
+
+    # Returns the prefetched page, waiting up to PREFETCH_WAIT for it, or None
+    def _wait(self, session, future):
+        if future.done():
+            self.counters['hits'] += 1
+        else:
+            self.counters['waits'] += 1
+        try:
+            return future.result(timeout=Config.PREFETCH_WAIT)
+        except TimeoutError:
+            logging.warning(f"Prefetched page for {session.client_id} not ready, generating a new one")
+        except Exception as e:
+            self.counters['errors'] += 1
+            logging.error(f"Prefetch for {session.client_id} failed: {e}")
+        finally:
+            with self.lock:
+                if session.future is future:
+                    session.future = None
+        return None
+
+    # Records the first page of a query for this client and makes sure the next one is on its way
+    def start(self, client_id, query, recommendations):
+        if not Config.PREFETCH_ENABLED:
+            return
+        with self.lock:
+            self._evict()
+            previous = self.sessions.pop(client_id, None)
+            if previous is not None:
+                previous.cancel()
+            session = self.sessions[client_id] = PrefetchSession(client_id, query, Config.PREFETCH_MAX_SHOWN)
+            session.add_shown(recommendations)
+            self._schedule(session)
+
+    # Returns the next page for this client: unseen pooled titles, else the
+    # prefetched page (or a running pool refill), else a freshly generated
+    # page that excludes what the client has already seen
+    def next_page(self, client_id, query, count=3):
+        future = None
+        with self.lock:
+            self._evict()
+            session = self.sessions.get(client_id)
+            if session is None or session.key != make_query_key(*query):
+                session = None
+            else:
+                self.sessions.move_to_end(client_id)
+                session.last_used = time.time()
+                future = session.future
+
+        recommendations = recommendation_pool.take_unseen(*query, client_id=client_id, count=count)
+        if recommendations is not None:
+            self.counters['pool_hits'] += 1
+        else:
+            prefetched = None
+            if future is not None:
+                prefetched = self._wait(session, future)
+            else:
+                recommendation_pool.wait_for_refill(*query, timeout=Config.PREFETCH_WAIT)
+            # A finished prefetch or refill has landed in the pool
+            recommendations = recommendation_pool.take_unseen(*query, client_id=client_id, count=count)
+            if recommendations is None and prefetched:
+                # Pooling is off; use the prefetched page directly
+                shown = {title.lower() for title in session.shown}
+                recommendations = [dict(rec) for rec in prefetched if rec['title'].lower() not in shown][:count] or None
+
+        if recommendations is None:
+            self.counters['misses'] += 1
+            if recommendation_pool.enabled:
+                recommendations = recommendation_pool.take(*query, client_id=client_id, count=count)
+            else:
+                exclude = list(session.shown) if session is not None else []
+                recommendations = get_recommendations(*query, exclude=exclude)
+
+        recommendation_pool.remember(*query, client_id=client_id, recommendations=recommendations)
+        if Config.PREFETCH_ENABLED:
+            with self.lock:
+                if session is None or self.sessions.get(client_id) is not session:
+                    shown = session.shown if session is not None else []
+                    session = self.sessions[client_id] = PrefetchSession(client_id, query, Config.PREFETCH_MAX_SHOWN)
+                    session.shown = list(shown)
+                session.add_shown(recommendations)
+                self._schedule(session, count)
+        return [dict(rec) for rec in recommendations]
+
+    # Drops every session and waits for prefetches that already started (their
+    # pages still go into the pool). Counters are left alone.
+    def reset(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.cancel()
+            self.sessions.clear()
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['sessions'] = len(self.sessions)
+        return stats
+
+
+page_prefetcher = PagePrefetcher()
@@ -0,0 +1,265 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from config import Config
+from app.recommendations import get_recommendations
+from app.admission import AdmissionRejected
+from app.singleflight import SingleFlight, get_shared_store
+
+# Normalizes a query so equivalent requests share a pool
+def make_query_key(movie=None, genres=None, moods=None, streaming_services=None):
+    def normalize(values):
+        return tuple(sorted({' '.join(value.lower().split()) for value in values or [] if value and value.strip()}))
+
+    movie = ' '.join((movie or '').lower().split())
+    return (movie, normalize(genres), normalize(moods), normalize(streaming_services))
+
+
+# Identical queries that are generating at the same time share one OpenAI call
+recommendation_flights = SingleFlight('recommendations', store=get_shared_store())
+
+# The shared call excludes the titles of whichever caller started it, so each
+# caller drops its own excluded titles from the result afterwards and tops the
+# page up with its own call if that leaves it short
+def get_recommendations_coalesced(movie=None, genres=None, moods=None, streaming_services=None, exclude=None, count=3):
+    key = repr(make_query_key(movie, genres, moods, streaming_services))
+    excluded = {title.lower() for title in exclude or []}
+    recommendations = recommendation_flights.do(key, lambda: get_recommendations(movie, genres, moods, streaming_services, exclude=exclude, count=count))
+    fresh = [dict(rec) for rec in recommendations if rec['title'].lower() not in excluded]
+    if len(fresh) < count:
+        top_up_exclude = list(exclude or []) + [rec['title'] for rec in fresh]
+        fresh += get_recommendations(movie, genres, moods, streaming_services, exclude=top_up_exclude, count=count - len(fresh))
+    return fresh
+
+
+class QueryPool:
+    def __init__(self, key, max_size, max_clients):
+        self.key = key
+        self.created_at = time.time()
+        self.recommendations = deque(maxlen=max_size)
+        self.shown = OrderedDict()  # client id -> titles already returned to that client
+        self.max_clients = max_clients
+        self.refilling = False
+        self.refill_future = None
+        self.exhausted = False  # the last refill found nothing new
+
+    def titles(self):
+        return {rec['title'].lower() for rec in self.recommendations}
+
+    def add(self, recommendations):
+        titles = self.titles()
+        added = 0
+        for rec in recommendations:
+            if rec['title'].lower() not in titles:
+                self.recommendations.append(rec)
+                titles.add(rec['title'].lower())
+                added += 1
+        if added:
+            self.exhausted = False
+        return added
+
+    def shown_to(self, client_id):
+        shown = self.shown.get(client_id)
+        if shown is None:
+            shown = self.shown[client_id] = set()
+            while len(self.shown) > self.max_clients:
+                self.shown.popitem(last=False)
+        else:
+            self.shown.move_to_end(client_id)
+        return shown
+
+    def unseen(self, client_id):
+        shown = self.shown_to(client_id)
+        return [rec for rec in self.recommendations if rec['title'].lower() not in shown]
+
+    def mark_shown(self, client_id, recommendations):
+        self.shown_to(client_id).update(rec['title'].lower() for rec in recommendations)
+
+
+# Holds many parsed recommendations per normalized query so repeat queries can
+# be answered without waiting on OpenAI. Pools that run low for a client are
+# refilled in the background; pools are capped by count and age.
+class RecommendationPool:
+    def __init__(self, app=None):
+        self.pools = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = None
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'refills': 0,
+            'refills_skipped': 0,
+            'refill_errors': 0,
+            'evictions': 0,
+        }
+        self.configure(Config.__dict__)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(app.config)
+
+    def configure(self, config):
+        self.enabled = config.get('RECOMMENDATION_POOL_ENABLED', True)
+        self.max_size = config.get('RECOMMENDATION_POOL_MAX_SIZE', 30)
+        self.low_water = config.get('RECOMMENDATION_POOL_LOW_WATER', 6)
+        self.max_queries = config.get('RECOMMENDATION_POOL_MAX_QUERIES', 500)
+        self.max_age = config.get('RECOMMENDATION_POOL_MAX_AGE', 6 * 3600)
+        self.max_clients = config.get('RECOMMENDATION_POOL_MAX_CLIENTS', 1000)
+        self.workers = config.get('RECOMMENDATION_POOL_WORKERS', 2)
+
+    def _get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pool-refill')
+        return self.executor
+
+    # Returns the pool for key, dropping it if it's too old. Caller holds the lock.
+    def _get_pool(self, key, create=False):
+        pool = self.pools.get(key)
+        if pool is not None and time.time() - pool.created_at > self.max_age:
+            del self.pools[key]
+            self.counters['evictions'] += 1
+            pool = None
+        if pool is None and create:
+            pool = self.pools[key] = QueryPool(key, self.max_size, self.max_clients)
+            while len(self.pools) > self.max_queries:
+                self.pools.popitem(last=False)
+                self.counters['evictions'] += 1
+        if pool is not None:
+            self.pools.move_to_end(key)
+        return pool
+
+    # Returns count pooled recommendations this client hasn't been shown for
+    # the query, or None if the pool can't cover them. Never generates.
+    def take_unseen(self, movie=None, genres=None, moods=None, streaming_services=None, client_id=None, count=3):
+        if not self.enabled:
+            return None
+        key = make_query_key(movie, genres, moods, streaming_services)
+        with self.lock:
+            pool = self._get_pool(key)
+            unseen = pool.unseen(client_id) if pool else []
+            if len(unseen) < count:
+                return None
+            selected = unseen[:count]
+            pool.mark_shown(client_id, selected)
+            self.counters['hits'] += 1
+            if len(unseen) - count < self.low_water:
+                self._schedule_refill(pool, (movie, genres, moods, streaming_services))
+            return [dict(rec) for rec in selected]
+
+    # Whether the client's next page is pooled already or on its way from a refill
+    def has_next_page(self, movie=None, genres=None, moods=None, streaming_services=None, client_id=None, count=3):
+        if not self.enabled:
+            return False
+        with self.lock:
+            pool = self._get_pool(make_query_key(movie, genres, moods, streaming_services))
+            return pool is not None and (pool.refilling or len(pool.unseen(client_id)) >= count)
+
+    # Waits up to timeout for a running refill of the query's pool. Returns
+    # False if there was none.
+    def wait_for_refill(self, movie=None, genres=None, moods=None, streaming_services=None, timeout=None):
+        if not self.enabled:
+            return False
+        with self.lock:
+            pool = self._get_pool(make_query_key(movie, genres, moods, streaming_services))
+            future = pool.refill_future if pool is not None and pool.refilling else None
+        if future is None:
+            return False
+        wait([future], timeout=timeout)
+        return True
+
+    # Returns count recommendations this client hasn't been shown for the query
+    def take(self, movie=None, genres=None, moods=None, streaming_services=None, client_id=None, count=3):
+        if not self.enabled:
+            return get_recommendations_coalesced(movie, genres, moods, streaming_services, count=count)
+
+        selected = self.take_unseen(movie, genres, moods, streaming_services, client_id=client_id, count=count)
+        if selected is not None:
+            return selected
+
+        key = make_query_key(movie, genres, moods, streaming_services)
+        query = (movie, genres, moods, streaming_services)
+
+        with self.lock:
+            pool = self._get_pool(key)
+            unseen = pool.unseen(client_id) if pool else []
+            self.counters['misses'] += 1
+            # Nothing this client has seen, nor anything already pooled
+            exclude = list(pool.shown_to(client_id) | pool.titles()) if pool else []
+
+        # Cold or exhausted pool: generate now and keep the result for others.
+        # Pooled titles the client hasn't seen yet go first.
+        recommendations = get_recommendations_coalesced(movie, genres, moods, streaming_services, exclude=exclude, count=count)
+        with self.lock:
+            pool = self._get_pool(key, create=True)
+            pool.add(recommendations)
+            selected = (unseen + recommendations)[:count]
+            pool.mark_shown(client_id, selected)
+            self._schedule_refill(pool, query)
+        return [dict(rec) for rec in selected]
+
+    # Adds recommendations generated elsewhere (e.g. a prefetched page) to the
+    # query's pool and, given a client, records that the client has seen them
+    def remember(self, movie=None, genres=None, moods=None, streaming_services=None, client_id=None, recommendations=()):
+        if not self.enabled:
+            return
+        key = make_query_key(movie, genres, moods, streaming_services)
+        with self.lock:
+            pool = self._get_pool(key, create=True)
+            pool.add([dict(rec) for rec in recommendations])
+            if client_id is not None:
+                pool.mark_shown(client_id, recommendations)
+
+    # Caller holds the lock. Pools whose last refill added nothing aren't
+    # refilled again until something new reaches them.
+    def _schedule_refill(self, pool, query):
+        if pool.refilling or pool.exhausted:
+            return
+        pool.refilling = True
+        pool.refill_future = self._get_executor().submit(self._refill, pool, query)
+
+    def _refill(self, pool, query):
+        try:
+            with self.lock:
+                exclude = [rec['title'] for rec in pool.recommendations]
+            # Not coalesced: a refill that finds no free admission slot is
+            # skipped, which mustn't fail a request that joined its flight
+            recommendations = get_recommendations(*query, exclude=exclude, background=True)
+            with self.lock:
+                added = pool.add(recommendations)
+                pool.exhausted = not added
+                self.counters['refills'] += 1
+            logging.debug(f"Refilled pool {pool.key} with {added} recommendation(s)")
+        except AdmissionRejected:
+            with self.lock:
+                self.counters['refills_skipped'] += 1
+            logging.debug(f"Skipped refilling pool {pool.key}, no free admission slot")
+        except Exception as e:
+            with self.lock:
+                self.counters['refill_errors'] += 1
+            logging.error(f"Error refilling recommendation pool {pool.key}: {e}")
+        finally:
+            pool.refilling = False
+
+    # Waits for running and queued refills, then drops every pool, e.g.
+    # between benchmark runs. Counters are left alone.
+    def reset(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self.lock:
+            self.pools.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['queries'] = len(self.pools)
+            stats['recommendations'] = sum(len(pool.recommendations) for pool in self.pools.values())
+        return stats
+
+
+recommendation_pool = RecommendationPool()
@@ -1,9 +1,21 @@
+import copy
 import openai
 import os
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 import random
+import json
+import re
+from config import Config
+from app.poster_cache import poster_cache
+from app.catalog import movie_catalog, normalize_service
+from app.metrics import span, upstream_calls, model_retries, parse_failures, request_model_calls, request_tokens
+from app.singleflight import SingleFlight, SingleFlightError, get_shared_store
+from app.upstream import Upstream, UpstreamError
+from app.admission import admission_controller
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -22,51 +34,266 @@ if openai.api_key is None or tmdb_api_key is None or tmdb_access_token is None:
     logging.error(error_message)
     raise ValueError(error_message)
 
-# Function to prompt and chat with GPT-3
-def chat_with_gpt(prompt):
+# Shared TMDB session so poster lookups reuse pooled keep-alive connections
+tmdb_session = requests.Session()
+tmdb_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=Config.TMDB_POOL_SIZE)
+tmdb_session.mount('https://', tmdb_adapter)
+tmdb_session.mount('http://', tmdb_adapter)
+tmdb_session.headers.update({'Authorization': f'Bearer {tmdb_access_token}'})
+
+# Worker pool used to run the poster lookups for a response concurrently
+poster_executor = ThreadPoolExecutor(max_workers=Config.TMDB_POOL_SIZE, thread_name_prefix='tmdb')
+
+# Server errors and rate limiting are worth retrying; other 4xx responses
+# (a bad key, a bad request) won't change and say nothing about TMDB's health
+def is_retryable_tmdb_error(error):
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status is not None and (status >= 500 or status == 429)
+    return True
+
+# Deadlines, retries, hedging and circuit breakers for the two upstream APIs
+openai_upstream = Upstream(
+    'openai', deadline=Config.OPENAI_DEADLINE, retries=Config.OPENAI_RETRIES,
+    retryable=(openai.error.Timeout, openai.error.APIConnectionError, openai.error.ServiceUnavailableError, openai.error.APIError),
+    hedge=Config.OPENAI_HEDGE, hedge_percentile=Config.UPSTREAM_HEDGE_PERCENTILE, hedge_default_delay=Config.OPENAI_HEDGE_DELAY,
+    failure_threshold=Config.UPSTREAM_BREAKER_FAILURES, reset_timeout=Config.UPSTREAM_BREAKER_RESET,
+)
+tmdb_upstream = Upstream(
+    'tmdb', deadline=Config.TMDB_DEADLINE, retries=Config.TMDB_RETRIES,
+    retryable=(requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError),
+    retry_if=is_retryable_tmdb_error,
+    hedge=Config.TMDB_HEDGE, hedge_percentile=Config.UPSTREAM_HEDGE_PERCENTILE, hedge_default_delay=Config.TMDB_HEDGE_DELAY,
+    failure_threshold=Config.UPSTREAM_BREAKER_FAILURES, reset_timeout=Config.UPSTREAM_BREAKER_RESET,
+    # Requests (hedges included) never outnumber the session's pooled connections
+    max_workers=Config.TMDB_POOL_SIZE,
+)
+
+# Concurrent lookups of the same uncached title share one TMDB call
+poster_flights = SingleFlight('posters', timeout=Config.TMDB_DEADLINE, store=get_shared_store())
+
+# Labeled fields in a text recommendation block, mapped to their details keys
+FIELDS = ['Similarity', 'Title', 'Year', 'Runtime', 'Streaming Service',
+          'Rotten Tomatoes Critic Score', 'Rotten Tomatoes Audience Score', 'Synopsis',
+          'Reviews', 'IMDB']
+FIELD_KEYS = {field: field.lower().replace(' ', '_') for field in FIELDS}
+RECOMMENDATION_KEYS = list(FIELD_KEYS.values()) + ['explanation']
+
+# Function-call schema used by the structured (json) response mode
+RECOMMENDATION_FUNCTION = {
+    "name": "recommend_movies",
+    "description": "Return movie recommendations.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "recommendations": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "title": {"type": "string"},
+                        "year": {"type": "string"},
+                        "runtime": {"type": "string", "description": "Runtime in minutes"},
+                        "streaming_service": {"type": "string"},
+                        "rotten_tomatoes_critic_score": {"type": "string"},
+                        "rotten_tomatoes_audience_score": {"type": "string"},
+                        "synopsis": {"type": "string"},
+                        "reviews": {"type": "string"},
+                        "imdb": {"type": "string", "description": "Link to the IMDB page"},
+                        "similarity": {"type": "string", "description": "Percentage similarity to the requested movie"},
+                        "explanation": {"type": "string", "description": "1-2 sentences on why it is similar"}
+                    },
+                    "required": ["title", "year", "runtime", "streaming_service", "synopsis"]
+                }
+            }
+        },
+        "required": ["recommendations"]
+    }
+}
+
+# The function schema for one request. With a seed movie, recommendations
+# without a similarity and explanation are rejected, so the schema requires them.
+def recommendation_function(require_similarity=False):
+    function = copy.deepcopy(RECOMMENDATION_FUNCTION)
+    if require_similarity:
+        function['parameters']['properties']['recommendations']['items']['required'] += ['similarity', 'explanation']
+    return function
+
+# Adds the model calls and tokens of a completion to a per-request usage dict
+def record_usage(usage, response):
+    if usage is None:
+        return
+    usage['model_calls'] += 1
+    for key in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+        usage[key] += response.get('usage', {}).get(key, 0)
+
+def new_usage():
+    return {'model_calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+
+# Function to send a prompt to GPT-3 and return the reply message. kind keeps
+# the latencies of different prompts (full generations, short re-ranks) apart
+# for hedging.
+def chat_completion(prompt, usage=None, kind='generate', **kwargs):
     try:
         logging.debug(f"Sending prompt to OpenAI API: {prompt}")
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}]
-        )
+
+        def request():
+            try:
+                response = openai.ChatCompletion.create(
+                    model="gpt-3.5-turbo",
+                    messages=[{"role": "user", "content": prompt}],
+                    request_timeout=Config.OPENAI_TIMEOUT,
+                    **kwargs
+                )
+            except openai.error.OpenAIError:
+                upstream_calls.inc('openai', 'error')
+                raise
+            upstream_calls.inc('openai', 'ok')
+            return response
+
+        with span('openai'):
+            response = openai_upstream.call(request, kind=kind)
         logging.debug("Received response from OpenAI API")
-        return response.choices[0].message.content.strip()
+        record_usage(usage, response)
+        return response.choices[0].message
     except openai.error.OpenAIError as e:
         error_message = f"OpenAI API error: {e}"
         print(error_message)
         logging.error(error_message)
         raise
+    except UpstreamError as e:
+        error_message = f"OpenAI API unavailable: {e}"
+        print(error_message)
+        logging.error(error_message)
+        raise
     except Exception as e:
         error_message = f"Unexpected error: {e}"
         print(error_message)
         logging.error(error_message)
         raise
 
-# Function to get movie poster from TMDB API
-def get_poster_from_tmdb(title):
+# Function to prompt and chat with GPT-3
+def chat_with_gpt(prompt, usage=None, kind='generate'):
+    return (chat_completion(prompt, usage, kind).get('content') or '').strip()
+
+# Function to stream a completion from GPT-3, yielding text as it arrives
+def chat_with_gpt_stream(prompt):
     try:
-        headers = {
-            'Authorization': f'Bearer {tmdb_access_token}'
-        }
-        params = {
-            'api_key': tmdb_api_key,
-            'query': title
-        }
-        response = requests.get('https://api.themoviedb.org/3/search/movie', headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
-        if data['results']:
-            poster_path = data['results'][0].get('poster_path')
-            if poster_path:
-                return f"https://image.tmdb.org/t/p/w500{poster_path}" #returning the poster url
-        return None
-    except requests.exceptions.RequestException as e:
+        logging.debug(f"Streaming prompt to OpenAI API: {prompt}")
+
+        def request():
+            try:
+                return openai.ChatCompletion.create(
+                    model="gpt-3.5-turbo",
+                    messages=[{"role": "user", "content": prompt}],
+                    request_timeout=Config.OPENAI_TIMEOUT,
+                    stream=True
+                )
+            except openai.error.OpenAIError:
+                upstream_calls.inc('openai', 'error')
+                raise
+
+        # A stream can't be hedged, but still gets the deadline and breaker.
+        # Its call returns at the first byte, so it isn't tracked for hedging.
+        response = openai_upstream.call(request, hedge=False, kind='stream')
+        try:
+            for chunk in response:
+                content = chunk.choices[0].delta.get('content')
+                if content:
+                    yield content
+        except (openai.error.OpenAIError, requests.exceptions.RequestException):
+            # Failed after the call itself succeeded
+            upstream_calls.inc('openai', 'error')
+            openai_upstream.breaker.record_failure()
+            raise
+        upstream_calls.inc('openai', 'ok')
+        logging.debug("Finished streaming response from OpenAI API")
+    except openai.error.OpenAIError as e:
+        error_message = f"OpenAI API error: {e}"
+        print(error_message)
+        logging.error(error_message)
+        raise
+
+# Function to search TMDB for a movie poster. Raises on TMDB errors so they
+# aren't mistaken for "no poster found" and cached.
+def fetch_poster_from_tmdb(title, year=None):
+    def search(year):
+        def request():
+            try:
+                response = tmdb_session.get(f'{Config.TMDB_API_URL}/search/movie', params=tmdb_search_params(title, year), timeout=Config.TMDB_TIMEOUT)
+                response.raise_for_status()
+            except requests.exceptions.RequestException:
+                upstream_calls.inc('tmdb', 'error')
+                raise
+            upstream_calls.inc('tmdb', 'ok')
+            return response.json()
+
+        return poster_url_from_search(tmdb_upstream.call(request))
+
+    poster_url = search(year)
+    if poster_url is None and 'year' in tmdb_search_params(title, year):
+        # The model's year is often off by one; search by title alone before
+        # this is cached as "no poster"
+        poster_url = search(None)
+    return poster_url
+
+def tmdb_search_params(title, year=None):
+    params = {
+        'api_key': tmdb_api_key,
+        'query': title
+    }
+    if year and str(year).strip().isdigit():
+        params['year'] = str(year).strip()
+    return params
+
+def poster_url_from_search(data):
+    if data['results']:
+        poster_path = data['results'][0].get('poster_path')
+        if poster_path:
+            return f"https://image.tmdb.org/t/p/w500{poster_path}" #returning the poster url
+    return None
+
+# Function to get movie poster from TMDB API, going through the poster cache
+def get_poster_from_tmdb(title, year=None):
+    found, poster_url = poster_cache.get(title, year)
+    if found:
+        return poster_url
+
+    def fetch():
+        poster_url = fetch_poster_from_tmdb(title, year)
+        poster_cache.set(title, year, poster_url)
+        return poster_url
+
+    try:
+        return poster_flights.do(poster_cache.make_key(title, year), fetch)
+    except (requests.exceptions.RequestException, SingleFlightError, UpstreamError) as e:
+        # Includes an open TMDB circuit: the recommendation is returned without a poster
         error_message = f"TMDB API error: {e}"
         print(error_message)
         logging.error(error_message)
         return None
 
+# Looks up the posters for all recommendations at once. Lookups that miss the
+# overall deadline are dropped so a slow TMDB response can't hold up the page.
+def add_posters(recommendations):
+    futures = {poster_executor.submit(get_poster_from_tmdb, rec['title'], rec.get('year')): rec for rec in recommendations if 'poster_url' not in rec}
+    done, not_done = wait(futures, timeout=Config.TMDB_DEADLINE)
+
+    for future in done:
+        try:
+            poster_url = future.result()
+        except Exception as e:
+            logging.error(f"Unexpected error getting poster: {e}")
+            continue
+        if poster_url:
+            futures[future]['poster_url'] = poster_url
+
+    for future in not_done:
+        future.cancel()
+        logging.warning(f"Poster lookup timed out for: {futures[future]['title']}")
+
+    return recommendations
+
 # Converts runtime from minutes to hours and minutes
 def convert_runtime(runtime): 
     try:
@@ -78,9 +305,9 @@ def convert_runtime(runtime):
         logging.error(f"Error converting runtime: {e}")
         return runtime
 
-# Function to get recommendations from OpenAI
-def get_recommendations(movie=None, genres=None, moods=None, streaming_services=None):
-    prompt_options = ["Please recommend 3 movies", "Can you suggest 3 movies", "I would like 3 recommendations for movies"]
+# Builds the recommendation prompt for a query
+def build_prompt(movie=None, genres=None, moods=None, streaming_services=None, count=3, exclude=None, structured=False):
+    prompt_options = [f"Please recommend {count} movies", f"Can you suggest {count} movies", f"I would like {count} recommendations for movies"]
     prompt = random.choice(prompt_options)
 
     if movie:
@@ -95,6 +322,15 @@ def get_recommendations(movie=None, genres=None, moods=None, streaming_services=
     if movie:
         prompt += ". Ensure each recommendation includes a percentage similarity and an explanation of 1-2 sentences on why they are similar."
 
+    # Top-up requests must not repeat titles that were already returned
+    if exclude:
+        prompt += f" Do not recommend any of these titles: {'; '.join(exclude)}."
+
+    if structured:
+        prompt += " For each recommendation, please provide the title, the year it came out, the runtime in minutes, the streaming service, the Rotten Tomatoes critic score, the Rotten Tomatoes audience score, a 2-3 sentence synopsis with any well-known actors, 2-3 sentences about the reviews, and a link to the IMDB page. Respond by calling the recommend_movies function."
+        logging.debug(f"Generated prompt: {prompt}")
+        return prompt
+
     prompt += " For each recommendation, please provide the title, the year it came out, the runtime, the streaming service, the Rotten Tomatoes critic score, the Rotten Tomatoes audience score, a 2-3 sentence synopsis with any well-known actors of the recommended movie or TV show, 2-3 sentences about the reviews, and a link to the IMDB page. Ensure each piece of information is on a new line and clearly labeled as follows:"
 
     if movie:
@@ -119,71 +355,297 @@ Reviews: <reviews>
 IMDB: <imdb link>
 """
     logging.debug(f"Generated prompt: {prompt}")
+    return prompt
+
+# Parses and validates one recommendation block, raising ValueError if it's unusable
+def parse_recommendation(rec, require_similarity=True):
+    details = extract_details(rec)
+    logging.debug(f"Parsed details: {details}")
+    # Skip recommendations without title, similarity, or explanation
+    if not details.get('title'):
+        raise ValueError("Missing title")
+    if require_similarity and (details['similarity'] == "N/A" or details['explanation'] == "No explanation provided."):
+        raise ValueError("Missing title, similarity, or explanation")
+
+    if "runtime" in details:
+        details["runtime"] = convert_runtime(details["runtime"])
+
+    return details
+
+# Validates one recommendation from the recommend_movies function call
+def parse_structured_recommendation(rec, require_similarity=True):
+    if not isinstance(rec, dict):
+        raise ValueError("Recommendation is not an object")
+    details = {key: str(rec.get(key) or '').strip() for key in RECOMMENDATION_KEYS}
+    if not details['title']:
+        raise ValueError("Missing title")
+    if not details['similarity'] or not details['explanation']:
+        if require_similarity:
+            raise ValueError("Missing similarity or explanation")
+        details['similarity'] = "N/A"
+        details['explanation'] = "No explanation provided."
+
+    if details['runtime']:
+        details['runtime'] = convert_runtime(details['runtime'])
+
+    return details
+
+# Asks for recommendations through a function-call schema, returning the raw
+# list of recommendation objects. Raises ValueError if the arguments are malformed.
+def request_structured_recommendations(prompt, usage=None, require_similarity=False):
+    message = chat_completion(prompt, usage, functions=[recommendation_function(require_similarity)], function_call={"name": "recommend_movies"})
+    return parse_function_call(message)
+
+def parse_function_call(message):
+    try:
+        arguments = json.loads(message['function_call']['arguments'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Malformed function call from OpenAI: {e}")
+    recommendations = arguments.get('recommendations') if isinstance(arguments, dict) else None
+    if not isinstance(recommendations, list):
+        raise ValueError("Function call is missing the recommendations list")
+    return recommendations
+
+# Picks catalog candidates for a query, or returns None when the catalog can't
+# cover it and the model should generate recommendations from scratch
+def get_catalog_candidates(movie=None, genres=None, streaming_services=None, exclude=None, count=3):
+    if not Config.CATALOG_ENABLED:
+        return None
+    if movie and not genres and movie_catalog.find(movie) is None:
+        # Without the seed's genres the only filter left would be the
+        # services, i.e. the same popular titles for every seed
+        return None
+    candidates = movie_catalog.candidates(movie, genres, streaming_services, exclude=exclude)
+    if len(candidates) < max(count, Config.CATALOG_MIN_CANDIDATES):
+        return None
+    return candidates
+
+# Builds a short prompt asking the model to re-rank catalog candidates
+def build_rerank_prompt(movie=None, genres=None, moods=None, candidates=(), count=3):
+    wants = []
+    if movie:
+        wants.append(f"similarity to {movie}")
+    if genres:
+        wants.append(f"the genres: {', '.join(genres)}")
+    if moods:
+        wants.append(f"someone who is looking for something {', '.join(moods)}")
+    prompt = f"From the numbered list below, pick the {count} movies that best fit {'; '.join(wants) or 'a general audience'}."
+    if movie:
+        prompt += " Reply with one line per pick, formatted as: <number>; <similarity percentage>; <1-2 sentences on why they are similar>"
+    else:
+        prompt += " Reply with one line per pick, formatted as: <number>; <1-2 sentences on why it fits>"
+    prompt += "\n" + "\n".join(f"{index}. {candidate['title']} ({candidate['year'] or 'n/a'})" for index, candidate in enumerate(candidates, 1))
+    logging.debug(f"Generated re-rank prompt: {prompt}")
+    return prompt
+
+# Builds recommendation details for a catalog movie. Metadata and the poster
+# come from the catalog rather than the model or TMDB.
+def catalog_details(candidate, streaming_services=None, similarity="N/A", explanation="No explanation provided."):
+    wanted = {normalize_service(service) for service in streaming_services or []}
+    services = [service for service in candidate['streaming_services'] if service in wanted] or candidate['streaming_services']
 
-    recommendations_with_posters = []
+    details = {key: '' for key in RECOMMENDATION_KEYS}
+    details.update({
+        'title': candidate['title'],
+        'year': str(candidate['year'] or ''),
+        'runtime': convert_runtime(str(candidate['runtime'])) if candidate['runtime'] else '',
+        'streaming_service': ', '.join(service.title() for service in services),
+        'rotten_tomatoes_critic_score': "N/A",
+        'rotten_tomatoes_audience_score': "N/A",
+        'synopsis': candidate['overview'],
+        'imdb': f"https://www.imdb.com/title/{candidate['imdb_id']}/" if candidate['imdb_id'] else '',
+        'similarity': similarity,
+        'explanation': explanation,
+    })
+    if candidate['poster_path']:
+        details['poster_url'] = f"https://image.tmdb.org/t/p/w500{candidate['poster_path']}"
+    return details
+
+RERANK_LINE = re.compile(r'^\s*(\d+)[.)]?\s*;\s*(.+)$')
 
-    while len(recommendations_with_posters) < 3:
-        recommendations = chat_with_gpt(prompt)
-        logging.debug(f"Recommendations from OpenAI: {recommendations}")
+# Parses the re-rank reply into recommendation details, skipping lines that
+# don't point at a candidate or lack the similarity a seed movie requires
+def parse_rerank_reply(reply, candidates, movie=None, streaming_services=None, count=3):
+    picks = []
+    seen = set()
+    for line in reply.split('\n'):
+        match = RERANK_LINE.match(line)
+        if not match:
+            continue
+        index = int(match.group(1)) - 1
+        if index < 0 or index >= len(candidates) or index in seen:
+            parse_failures.inc('rerank')
+            continue
+        parts = [part.strip() for part in match.group(2).split(';', 1)]
+        if movie:
+            if len(parts) < 2 or not parts[0] or not parts[1]:
+                parse_failures.inc('rerank')
+                continue
+            details = catalog_details(candidates[index], streaming_services, parts[0], parts[1])
+        else:
+            details = catalog_details(candidates[index], streaming_services, explanation=parts[-1])
+        seen.add(index)
+        picks.append(details)
+        if len(picks) >= count:
+            break
+    return picks
 
-        recommendations_list = recommendations.split('\n\n')
-        
+# Re-ranks catalog candidates with the model. Returns the picks (possibly
+# fewer than count), or an empty list when the catalog can't serve the query.
+def get_catalog_recommendations(movie=None, genres=None, moods=None, streaming_services=None, exclude=None, usage=None, count=3):
+    candidates = get_catalog_candidates(movie, genres, streaming_services, exclude, count)
+    if not candidates:
+        return []
+    try:
+        reply = chat_with_gpt(build_rerank_prompt(movie, genres, moods, candidates, count), usage, kind='rerank')
+    except Exception as e:
+        logging.error(f"Catalog re-rank failed, generating instead: {e}")
+        return []
+    with span('parse'):
+        return parse_rerank_reply(reply, candidates, movie, streaming_services, count)
+
+# Validates candidate recommendations from one completion and appends the
+# usable, not yet seen ones to parsed_recommendations (and their titles to excluded)
+def collect_recommendations(recommendations_list, parsed_recommendations, excluded, count, structured, require_similarity):
+    titles = {title.lower() for title in excluded}
+    with span('parse'):
         for rec in recommendations_list:
+            if len(parsed_recommendations) >= count:
+                break
             try:
-                details = extract_details(rec)
-                logging.debug(f"Parsed details: {details}")
-                # Skip recommendations without title, similarity, or explanation
-                if not details.get('title') or details['similarity'] == "N/A" or details['explanation'] == "No explanation provided.":
-                    raise ValueError("Missing title, similarity, or explanation")
-                title = details['title']
-                poster_url = get_poster_from_tmdb(title)
-                if poster_url:
-                    details['poster_url'] = poster_url
-
-                if "runtime" in details:
-                    details["runtime"] = convert_runtime(details["runtime"])
-
-                recommendations_with_posters.append(details)
-                if len(recommendations_with_posters) >= 3:
-                    break
+                if structured:
+                    details = parse_structured_recommendation(rec, require_similarity)
+                else:
+                    details = parse_recommendation(rec, require_similarity)
+                if details['title'].lower() in titles:
+                    parse_failures.inc('duplicate')
+                    logging.error(f"Skipping duplicate recommendation: {details['title']}")
+                    continue
+                titles.add(details['title'].lower())
+                excluded.append(details['title'])
+                parsed_recommendations.append(details)
             except ValueError as e:
+                parse_failures.inc('invalid')
                 logging.error(f"Skipping recommendation due to error: {e}")
             except Exception as e:
+                parse_failures.inc('error')
                 logging.error(f"Unexpected error: {e}")
 
-    logging.debug(f"Final recommendations with posters: {recommendations_with_posters}")
-    return recommendations_with_posters
+# Reports the per-request usage and fails if nothing usable came back
+def finish_usage(usage, parsed_recommendations):
+    usage['recommendations'] = len(parsed_recommendations)
+    if usage['model_calls'] > 1:
+        model_retries.inc(amount=usage['model_calls'] - 1)
+    request_model_calls.observe(usage['model_calls'])
+    request_tokens.observe(usage['prompt_tokens'], 'prompt')
+    request_tokens.observe(usage['completion_tokens'], 'completion')
+    logging.info(f"Recommendation usage: {usage}")
+    if not parsed_recommendations:
+        raise ValueError(f"No valid recommendations after {usage['model_calls']} model call(s)")
+
+# Function to get recommendations from OpenAI. Stops after
+# RECOMMENDATIONS_MAX_MODEL_CALLS completions; follow-up calls only ask for the
+# missing count and exclude titles that were already returned.
+def get_recommendations(movie=None, genres=None, moods=None, streaming_services=None, exclude=None, usage=None, count=3, background=False):
+    # Each generation holds an admission slot; background ones (pool refills,
+    # prefetches) only take a free one and raise AdmissionRejected otherwise
+    with admission_controller.slot(background):
+        usage = new_usage() if usage is None else usage
+        structured = Config.RECOMMENDATIONS_MODE == 'json'
+        require_similarity = bool(movie)
+        excluded = list(exclude or [])
+
+        # Prefer re-ranking the local catalog; the model only generates what's left
+        parsed_recommendations = get_catalog_recommendations(movie, genres, moods, streaming_services, excluded, usage, count)
+        excluded.extend(rec['title'] for rec in parsed_recommendations)
+
+        while len(parsed_recommendations) < count and usage['model_calls'] < Config.RECOMMENDATIONS_MAX_MODEL_CALLS:
+            prompt = build_prompt(movie, genres, moods, streaming_services, count=count - len(parsed_recommendations), exclude=excluded, structured=structured)
+
+            try:
+                if structured:
+                    recommendations_list = request_structured_recommendations(prompt, usage, require_similarity)
+                else:
+                    recommendations = chat_with_gpt(prompt, usage)
+                    logging.debug(f"Recommendations from OpenAI: {recommendations}")
+                    recommendations_list = recommendations.split('\n\n')
+            except ValueError as e:
+                parse_failures.inc('malformed_response')
+                logging.error(f"Skipping response due to error: {e}")
+                continue
+
+            collect_recommendations(recommendations_list, parsed_recommendations, excluded, count, structured, require_similarity)
+
+        finish_usage(usage, parsed_recommendations)
+
+        with span('tmdb'):
+            recommendations_with_posters = add_posters(parsed_recommendations)
 
+        logging.debug(f"Final recommendations with posters: {recommendations_with_posters}")
+        return recommendations_with_posters
+
+# Splits streamed completion text into blocks as soon as each one is complete
+def iter_recommendation_blocks(chunks):
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        while '\n\n' in buffer:
+            block, buffer = buffer.split('\n\n', 1)
+            if block.strip():
+                yield block
+    if buffer.strip():
+        yield buffer
+
+# Streaming version of get_recommendations: yields each recommendation, with
+# its poster, as soon as its block has been received and parsed
+def stream_recommendations(movie=None, genres=None, moods=None, streaming_services=None, count=3):
+    titles = set()
+    excluded = []
+    attempts = 0
+
+    while len(titles) < count and attempts < Config.RECOMMENDATIONS_MAX_MODEL_CALLS:
+        attempts += 1
+        prompt = build_prompt(movie, genres, moods, streaming_services, count=count - len(titles), exclude=excluded)
+        for rec in iter_recommendation_blocks(chat_with_gpt_stream(prompt)):
+            try:
+                details = parse_recommendation(rec, bool(movie))
+            except ValueError as e:
+                parse_failures.inc('invalid')
+                logging.error(f"Skipping recommendation due to error: {e}")
+                continue
+            if details['title'].lower() in titles:
+                continue
+            titles.add(details['title'].lower())
+            excluded.append(details['title'])
+            with span('tmdb'):
+                details = add_posters([details])[0]
+            yield details
+            if len(titles) >= count:
+                return
+
+# Parses a labeled recommendation block in a single pass over its lines
 def extract_details(recommendation):
     details = {}
     lines = recommendation.split('\n')
     logging.debug(f"Extracting details from: {lines}")
 
-    fields = ['Similarity', 'Title', 'Year', 'Runtime', 'Streaming Service', 
-              'Rotten Tomatoes Critic Score', 'Rotten Tomatoes Audience Score', 'Synopsis', 
-              'Reviews', 'IMDB']
+    for line in lines:
+        label, separator, value = line.partition(':')
+        key = FIELD_KEYS.get(label)
+        # The first line for each field wins
+        if separator and key and key not in details:
+            details[key] = value.strip()
 
-    for field in fields:
-        details[field.lower().replace(' ', '_')] = extract_field(lines, f"{field}:")
+    for key in FIELD_KEYS.values():
+        details.setdefault(key, '')
 
     # Ensure similarity and explanation are included if a movie is provided
-    if 'similarity' in details:
-        if ';' in details['similarity']:
-            similarity, explanation = details['similarity'].split(';', 1)
-            details['similarity'] = similarity.strip()
-            details['explanation'] = explanation.strip()
-        else:
-            details['similarity'] = "N/A"
-            details['explanation'] = "No explanation provided."
+    if ';' in details['similarity']:
+        similarity, explanation = details['similarity'].split(';', 1)
+        details['similarity'] = similarity.strip()
+        details['explanation'] = explanation.strip()
     else:
         details['similarity'] = "N/A"
         details['explanation'] = "No explanation provided."
 
     return details
-
-def extract_field(lines, field):
-    for line in lines:
-        if line.startswith(field):
-            logging.debug(f"Extracting field '{field}' from line: {line}")
-            return line.split(field, 1)[1].strip()
-    return ''
\ No newline at end of file
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+from config import Config
+from app.sqlite_store import SQLiteStore
+from app.admission import AdmissionRejected
+
+
+class SingleFlightError(RuntimeError):
+    pass
+
+
+class SingleFlightTimeout(SingleFlightError):
+    pass
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+# Coalesces concurrent calls with the same key: the first caller runs fn and
+# everyone else waiting on that key gets its result (or its exception). With a
+# shared store, callers in other gunicorn workers on the same host are
+# coalesced too.
+class SingleFlight:
+    def __init__(self, name, timeout=None, store=None):
+        self.name = name
+        self.timeout = timeout or Config.SINGLEFLIGHT_TIMEOUT
+        self.store = store
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.counters = {'leaders': 0, 'shared': 0, 'timeouts': 0}
+
+    def do(self, key, fn, timeout=None):
+        timeout = timeout or self.timeout
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.counters['leaders'] += 1
+            else:
+                flight.waiters += 1
+                self.counters['shared'] += 1
+
+        if not leader:
+            if not flight.done.wait(timeout):
+                with self.lock:
+                    self.counters['timeouts'] += 1
+                raise SingleFlightTimeout(f"Timed out waiting for in-flight {self.name} call")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            if self.store is not None:
+                flight.result = self.store.run(f"{self.name}:{key}", fn, timeout)
+            else:
+                flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+            if flight.waiters:
+                logging.debug(f"Shared {self.name} call {key} with {flight.waiters} waiter(s)")
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['in_flight'] = len(self.flights)
+        return stats
+
+
+# asyncio version of SingleFlight for the async request path (one event loop)
+class AsyncSingleFlight:
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.timeout = timeout or Config.SINGLEFLIGHT_TIMEOUT
+        self.flights = {}
+        self.counters = {'leaders': 0, 'shared': 0, 'timeouts': 0}
+
+    async def do(self, key, fn, timeout=None):
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = asyncio.ensure_future(fn())
+            flight.add_done_callback(lambda _: self.flights.pop(key, None))
+            self.counters['leaders'] += 1
+        else:
+            self.counters['shared'] += 1
+        try:
+            # shield so one waiter timing out doesn't cancel the call for the others
+            return await asyncio.wait_for(asyncio.shield(flight), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.counters['timeouts'] += 1
+            raise SingleFlightTimeout(f"Timed out waiting for in-flight {self.name} call")
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['in_flight'] = len(self.flights)
+        return stats
+
+
+# SQLite table of in-flight calls shared by the worker processes on a host.
+# The worker that claims a key runs the call and stores its JSON result or
+# error; the others poll until it's finished. Each call has its own row, kept
+# for retention seconds after it finishes, so a waiter that polls late still
+# finds its leader's result after a newer call for the key has started.
+class SharedFlightStore(SQLiteStore):
+    def __init__(self, path, poll_interval=None, retention=60):
+        super().__init__(path, (
+            "CREATE TABLE IF NOT EXISTS flight_calls ("
+            "key TEXT, owner TEXT, started REAL, finished REAL, result TEXT, error TEXT, PRIMARY KEY (key, owner))",
+        ))
+        self.poll_interval = poll_interval or Config.SINGLEFLIGHT_POLL_INTERVAL
+        self.retention = retention
+
+    # Claims key unless another worker is already running it. Stale claims
+    # (older than timeout) and finished calls get a new call.
+    def _claim(self, key, owner, timeout):
+        now = time.time()
+
+        def claim(conn):
+            row = conn.execute(
+                "SELECT owner FROM flight_calls WHERE key = ? AND finished IS NULL AND started > ? ORDER BY started LIMIT 1",
+                (key, now - timeout),
+            ).fetchone()
+            if row is not None:
+                return False, row[0]
+            conn.execute(
+                "INSERT INTO flight_calls (key, owner, started, finished, result, error) VALUES (?, ?, ?, NULL, NULL, NULL)",
+                (key, owner, now),
+            )
+            conn.execute(
+                "DELETE FROM flight_calls WHERE COALESCE(finished, started + ?) < ?",
+                (timeout, now - self.retention),
+            )
+            return True, owner
+
+        return self._transaction(claim)
+
+    def _finish(self, key, owner, result=None, error=None):
+        try:
+            self._connect().execute(
+                "UPDATE flight_calls SET finished = ?, result = ?, error = ? WHERE key = ? AND owner = ?",
+                (time.time(), result, error, key, owner),
+            )
+        except sqlite3.Error as e:
+            logging.error(f"Could not record result of {key} in shared single-flight store: {e}")
+
+    def _wait(self, key, owner, timeout):
+        deadline = time.time() + timeout
+        conn = self._connect()
+        while time.time() < deadline:
+            row = conn.execute("SELECT finished, result, error FROM flight_calls WHERE key = ? AND owner = ?", (key, owner)).fetchone()
+            if row is None:
+                raise SingleFlightError(f"In-flight call {key} expired before it finished")
+            if row[0] is not None:
+                if row[2] is not None:
+                    raise load_error(row[2])
+                return json.loads(row[1])
+            time.sleep(self.poll_interval)
+        raise SingleFlightTimeout(f"Timed out waiting for {key} in another worker")
+
+    def run(self, key, fn, timeout):
+        owner = uuid.uuid4().hex
+        try:
+            claimed, owner = self._claim(key, owner, timeout)
+        except sqlite3.Error as e:
+            logging.error(f"Shared single-flight store unavailable: {e}")
+            return fn()
+
+        if not claimed:
+            return self._wait(key, owner, timeout)
+
+        try:
+            result = fn()
+        except Exception as e:
+            self._finish(key, owner, error=dump_error(e))
+            raise
+        self._finish(key, owner, result=json.dumps(result))
+        return result
+
+
+# Errors cross workers as JSON. Admission rejections keep their status and
+# Retry-After so waiters in other workers are shed the same way as the leader.
+def dump_error(error):
+    data = {'message': str(error) or error.__class__.__name__}
+    if isinstance(error, AdmissionRejected):
+        data.update(status=error.status, reason=error.reason, retry_after=error.retry_after)
+    return json.dumps(data)
+
+
+def load_error(text):
+    data = json.loads(text)
+    if 'status' in data:
+        return AdmissionRejected(data['status'], data['reason'], data['retry_after'])
+    return SingleFlightError(data['message'])
+
+
+_shared_store = None
+
+# Returns the cross-worker store if SINGLEFLIGHT_DB is configured
+def get_shared_store():
+    global _shared_store
+    if _shared_store is None and Config.SINGLEFLIGHT_DB:
+        _shared_store = SharedFlightStore(Config.SINGLEFLIGHT_DB)
+    return _shared_store
@@ -0,0 +1,37 @@
+import os
+import sqlite3
+import threading
+
+
+# Base for state kept in a SQLite file shared by the worker processes on a
+# host. Each statement in schema is run once when the store is created.
+class SQLiteStore:
+    def __init__(self, path, schema=()):
+        self.path = path
+        self.local = threading.local()
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        for statement in schema:
+            conn.execute(statement)
+        conn.close()
+
+    # One connection per thread and process (connections must not cross a fork)
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    # Runs fn(conn) in a write transaction and returns its result
+    def _transaction(self, fn):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
@@ -0,0 +1,328 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from app.metrics import Counter, register_stats
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+
+upstream_attempts = Counter('watchbuddy_upstream_attempts_total', 'Attempts made through the upstream call layer.', ['upstream', 'kind'])
+upstream_hedges = Counter('watchbuddy_upstream_hedges_total', 'Hedged duplicate requests sent, and how many of them won.', ['upstream', 'outcome'])
+breaker_transitions = Counter('watchbuddy_circuit_breaker_transitions_total', 'Circuit breaker state changes.', ['upstream', 'state'])
+
+
+# Opens after failure_threshold consecutive failures, fails fast while open,
+# and lets a single probe through after reset_timeout (half-open)
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def _transition(self, state):
+        if state != self.state:
+            logging.warning(f"Circuit breaker for {self.name}: {self.state} -> {state}")
+            breaker_transitions.inc(self.name, state)
+            self.state = state
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open':
+                if time.time() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"{self.name} circuit is open")
+                self._transition('half_open')
+            if self.state == 'half_open':
+                if self.probing:
+                    raise CircuitOpenError(f"{self.name} circuit is half-open")
+                self.probing = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            self._transition('closed')
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                self._transition('open')
+
+
+# Rolling window of successful call latencies
+class LatencyTracker:
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct, min_samples=20):
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+# Shared wrapper for calls to an upstream API: an overall deadline, jittered
+# retries of retryable errors, a hedged duplicate request once the call has
+# taken longer than the observed hedge percentile, and a circuit breaker.
+# Latencies are tracked per kind of call (e.g. full completions vs short
+# re-rank prompts), and only for hedged calls, since a stream's call returns
+# at its first byte.
+# Errors are retryable (and count against the breaker) if they're instances of
+# retryable and, when given, retry_if(error) is true.
+class Upstream:
+    def __init__(self, name, deadline, retryable=(Exception,), retry_if=None, retries=2, backoff=0.2,
+                 hedge=True, hedge_percentile=95, hedge_min_delay=0.05, hedge_default_delay=1.0,
+                 failure_threshold=5, reset_timeout=30, max_workers=32):
+        self.name = name
+        self.deadline = deadline
+        self.retryable = retryable
+        self.retry_if = retry_if
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.latency = {}  # call kind -> LatencyTracker
+        self.max_workers = max_workers
+        self.executor = None
+        self.lock = threading.Lock()
+        self.counters = {'calls': 0, 'failures': 0, 'rejected': 0, 'hedges': 0, 'hedge_wins': 0, 'retries': 0}
+        register_stats(f'watchbuddy_upstream_{name}', f'Upstream call layer stats for {name}.', self.stats)
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f'upstream-{self.name}')
+            return self.executor
+
+    def is_retryable(self, error):
+        return isinstance(error, self.retryable) and (self.retry_if is None or self.retry_if(error))
+
+    def _tracker(self, kind):
+        with self.lock:
+            tracker = self.latency.get(kind)
+            if tracker is None:
+                tracker = self.latency[kind] = LatencyTracker()
+            return tracker
+
+    def hedge_delay(self, kind='default'):
+        observed = self._tracker(kind).percentile(self.hedge_percentile)
+        return max(self.hedge_min_delay, observed if observed is not None else self.hedge_default_delay)
+
+    def _timed(self, fn, tracker):
+        start = time.perf_counter()
+        result = fn()
+        if tracker is not None:
+            tracker.record(time.perf_counter() - start)
+        return result
+
+    def _sleep_before_retry(self, attempt, deadline_at):
+        delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+        if time.time() + delay >= deadline_at:
+            return False
+        time.sleep(delay)
+        return True
+
+    # Runs one attempt, hedging it if it's slow. Returns the first successful
+    # result; raises the last error if every request in the attempt failed.
+    def _attempt(self, fn, deadline_at, hedge, kind):
+        executor = self._get_executor()
+        tracker = self._tracker(kind) if hedge else None
+        upstream_attempts.inc(self.name, 'primary')
+        futures = {executor.submit(self._timed, fn, tracker): 'primary'}
+        hedge_at = time.time() + self.hedge_delay(kind) if hedge else None
+        error = None
+
+        while futures:
+            now = time.time()
+            if now >= deadline_at:
+                break
+            timeout = deadline_at - now
+            if hedge_at is not None:
+                timeout = min(timeout, max(0, hedge_at - now))
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                kind = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if kind == 'hedge':
+                    self._count('hedge_wins')
+                    upstream_hedges.inc(self.name, 'won')
+                for pending in futures:
+                    pending.cancel()
+                return result
+
+            if hedge_at is not None and time.time() >= hedge_at and futures:
+                hedge_at = None
+                self._count('hedges')
+                upstream_hedges.inc(self.name, 'sent')
+                upstream_attempts.inc(self.name, 'hedge')
+                futures[executor.submit(self._timed, fn, tracker)] = 'hedge'
+
+        for pending in futures:
+            pending.cancel()
+        if futures or error is None:
+            raise DeadlineExceeded(f"{self.name} call exceeded its {self.deadline}s deadline")
+        raise error
+
+    def call(self, fn, hedge=None, kind='default'):
+        hedge = self.hedge if hedge is None else hedge
+        try:
+            self.breaker.allow()
+        except CircuitOpenError:
+            self._count('rejected')
+            raise
+        self._count('calls')
+
+        deadline_at = time.time() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                result = self._attempt(fn, deadline_at, hedge, kind)
+                self.breaker.record_success()
+                return result
+            except DeadlineExceeded:
+                self._count('failures')
+                self.breaker.record_failure()
+                raise
+            except Exception as e:
+                if not self.is_retryable(e):
+                    # Not an upstream health problem (e.g. a bad request); don't trip the breaker
+                    self.breaker.record_success()
+                    raise
+                if attempt >= self.retries or not self._sleep_before_retry(attempt, deadline_at):
+                    self._count('failures')
+                    self.breaker.record_failure()
+                    raise
+                attempt += 1
+                self._count('retries')
+                upstream_attempts.inc(self.name, 'retry')
+                logging.warning(f"Retrying {self.name} call after error: {e}")
+
+    # asyncio version of call; coro_fn returns a new awaitable on each call
+    async def call_async(self, coro_fn, hedge=None, kind='default'):
+        hedge = self.hedge if hedge is None else hedge
+        try:
+            self.breaker.allow()
+        except CircuitOpenError:
+            self._count('rejected')
+            raise
+        self._count('calls')
+
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + self.deadline
+
+        tracker = self._tracker(kind) if hedge else None
+
+        async def timed():
+            start = time.perf_counter()
+            result = await coro_fn()
+            if tracker is not None:
+                tracker.record(time.perf_counter() - start)
+            return result
+
+        attempt = 0
+        while True:
+            upstream_attempts.inc(self.name, 'primary')
+            tasks = {asyncio.ensure_future(timed()): 'primary'}
+            hedge_at = loop.time() + self.hedge_delay(kind) if hedge else None
+            error = None
+            result = None
+            succeeded = False
+            try:
+                while tasks and not succeeded:
+                    now = loop.time()
+                    if now >= deadline_at:
+                        break
+                    timeout = deadline_at - now
+                    if hedge_at is not None:
+                        timeout = min(timeout, max(0, hedge_at - now))
+                    done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        kind = tasks.pop(task)
+                        if task.exception() is not None:
+                            error = task.exception()
+                            continue
+                        if kind == 'hedge':
+                            self._count('hedge_wins')
+                            upstream_hedges.inc(self.name, 'won')
+                        result, succeeded = task.result(), True
+                        break
+                    if not succeeded and hedge_at is not None and loop.time() >= hedge_at and tasks:
+                        hedge_at = None
+                        self._count('hedges')
+                        upstream_hedges.inc(self.name, 'sent')
+                        upstream_attempts.inc(self.name, 'hedge')
+                        tasks[asyncio.ensure_future(timed())] = 'hedge'
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+            if succeeded:
+                self.breaker.record_success()
+                return result
+            if error is None or loop.time() >= deadline_at:
+                self._count('failures')
+                self.breaker.record_failure()
+                raise DeadlineExceeded(f"{self.name} call exceeded its {self.deadline}s deadline")
+            if not self.is_retryable(error):
+                self.breaker.record_success()
+                raise error
+            delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            if attempt >= self.retries or loop.time() + delay >= deadline_at:
+                self._count('failures')
+                self.breaker.record_failure()
+                raise error
+            attempt += 1
+            self._count('retries')
+            upstream_attempts.inc(self.name, 'retry')
+            logging.warning(f"Retrying {self.name} call after error: {error}")
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats['circuit_open'] = int(self.breaker.state != 'closed')
+        with self.lock:
+            kinds = list(self.latency)
+        for kind in kinds:
+            stats[f'hedge_delay_{kind}_ms'] = round(self.hedge_delay(kind) * 1000, 1)
+        return stats
@@ -0,0 +1,182 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-ins for the OpenAI ChatCompletion and TMDB search/movie APIs, so
+# the app can be load tested without spending quota.
+
+TITLES = [
+    "The Grand Budapest Hotel", "Moonrise Kingdom", "Fantastic Mr. Fox", "Amelie", "Paddington 2",
+    "The Royal Tenenbaums", "Hunt for the Wilderpeople", "Little Miss Sunshine", "Juno", "Lady Bird",
+    "Knives Out", "Arrival", "Her", "Parasite", "Whiplash", "Inception", "Heat", "Zodiac",
+    "Sicario", "Prisoners", "Drive", "Nightcrawler", "Oldboy", "Memento", "The Prestige",
+]
+
+
+# Latency in seconds drawn from a log-normal distribution around median_ms
+class Latency:
+    def __init__(self, median_ms=0, sigma=0.0):
+        self.median = median_ms / 1000.0
+        self.sigma = sigma
+
+    def sample(self):
+        if self.median <= 0:
+            return 0
+        return random.lognormvariate(0, self.sigma) * self.median if self.sigma else self.median
+
+
+class FakeUpstream:
+    def __init__(self, latency=None, error_rate=0.0):
+        self.latency = latency or Latency()
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def record_call(self):
+        with self.lock:
+            self.calls += 1
+            failed = random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        return failed
+
+    def reset(self):
+        with self.lock:
+            self.calls = 0
+            self.errors = 0
+
+    def start(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                upstream.handle(self, 'GET')
+
+            def do_POST(self):
+                upstream.handle(self, 'POST')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def send_json(self, handler, status, payload):
+        body = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle(self, handler, method):
+        raise NotImplementedError
+
+
+class FakeOpenAI(FakeUpstream):
+    def __init__(self, latency=None, error_rate=0.0, malformed_rate=0.0):
+        super().__init__(latency, error_rate)
+        self.malformed_rate = malformed_rate
+
+    def recommendation_block(self, title, movie):
+        lines = []
+        if movie and random.random() >= self.malformed_rate:
+            lines.append(f"Similarity: {random.randint(60, 95)}%; Shares a similar tone and pacing.")
+        lines += [
+            f"Title: {title}",
+            f"Year: {random.randint(1990, 2023)}",
+            f"Runtime: {random.randint(85, 160)} minutes",
+            "Streaming Service: Netflix",
+            f"Rotten Tomatoes Critic Score: {random.randint(60, 99)}%",
+            f"Rotten Tomatoes Audience Score: {random.randint(60, 99)}%",
+            "Synopsis: A stand-in synopsis for load testing.",
+            "Reviews: Critics praised it.",
+            "IMDB: https://www.imdb.com/title/tt0000000/",
+        ]
+        return "\n".join(lines)
+
+    def recommendation_object(self, title, movie):
+        rec = {
+            "title": title,
+            "year": str(random.randint(1990, 2023)),
+            "runtime": str(random.randint(85, 160)),
+            "streaming_service": "Netflix",
+            "rotten_tomatoes_critic_score": f"{random.randint(60, 99)}%",
+            "rotten_tomatoes_audience_score": f"{random.randint(60, 99)}%",
+            "synopsis": "A stand-in synopsis for load testing.",
+            "reviews": "Critics praised it.",
+            "imdb": "https://www.imdb.com/title/tt0000000/",
+        }
+        if movie and random.random() >= self.malformed_rate:
+            rec["similarity"] = f"{random.randint(60, 95)}%"
+            rec["explanation"] = "Shares a similar tone and pacing."
+        return rec
+
+    def handle(self, handler, method):
+        length = int(handler.headers.get('Content-Length') or 0)
+        request = json.loads(handler.rfile.read(length) or b'{}')
+        time.sleep(self.latency.sample())
+        if self.record_call():
+            return self.send_json(handler, 500, {"error": {"message": "Injected failure", "type": "server_error"}})
+
+        prompt = request['messages'][0]['content']
+        movie = ' similar to ' in prompt
+        titles = random.sample(TITLES, 3)
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": 300, "total_tokens": len(prompt) // 4 + 300}
+
+        if request.get('functions'):
+            arguments = json.dumps({"recommendations": [self.recommendation_object(title, movie) for title in titles]})
+            message = {"role": "assistant", "content": None, "function_call": {"name": "recommend_movies", "arguments": arguments}}
+        else:
+            message = {"role": "assistant", "content": "\n\n".join(self.recommendation_block(title, movie) for title in titles)}
+
+        if request.get('stream'):
+            return self.send_stream(handler, message.get('content') or '')
+
+        self.send_json(handler, 200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get('model'),
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    def send_stream(self, handler, content):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        for start in range(0, len(content), 40):
+            chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": content[start:start + 40]}}]}
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            handler.wfile.flush()
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.close_connection = True
+
+
+class FakeTMDB(FakeUpstream):
+    def handle(self, handler, method):
+        query = parse_qs(urlparse(handler.path).query).get('query', [''])[0]
+        time.sleep(self.latency.sample())
+        if self.record_call():
+            return self.send_json(handler, 503, {"status_message": "Injected failure"})
+        self.send_json(handler, 200, {"results": [{"title": query, "poster_path": f"/{abs(hash(query))}.jpg"}]})
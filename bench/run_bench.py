@@ -0,0 +1,228 @@
+"""Offline load test for the recommendation routes.
+
+Starts local OpenAI/TMDB stand-ins, points the app at them and drives
+/api/recommendations and /api/form/recommendations through create_app() at a
+fixed concurrency. Reports throughput, latency percentiles and upstream calls
+per request, and compares them with a saved baseline.
+
+    python -m bench.run_bench --requests 200 --concurrency 20 --save-baseline
+    python -m bench.run_bench --requests 200 --concurrency 20
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.fakes import FakeOpenAI, FakeTMDB, Latency
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+MOVIES = ["Amelie", "Heat", "Arrival", "Paddington 2", "Knives Out", "Zodiac", "Her", "Juno"]
+GENRES = ["comedy", "drama", "sci-fi", "thriller/suspense", "animation"]
+MOODS = ["funny", "gripping", "heartwarming", "tense", "uplifting"]
+SERVICES = ["netflix", "hulu", "hbo", "amazon prime"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100, help='Requests per route')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--routes', default='api,form', help='Comma-separated subset of: api, form')
+    parser.add_argument('--distinct-queries', type=int, default=20, help='Number of distinct queries to draw from')
+    parser.add_argument('--openai-latency-ms', type=float, default=1500)
+    parser.add_argument('--openai-latency-sigma', type=float, default=0.3)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--malformed-rate', type=float, default=0.1, help='Share of blocks missing their Similarity line')
+    parser.add_argument('--tmdb-latency-ms', type=float, default=150)
+    parser.add_argument('--tmdb-latency-sigma', type=float, default=0.5)
+    parser.add_argument('--tmdb-error-rate', type=float, default=0.0)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='Overwrite the baseline with this run')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Allowed relative regression before failing')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args(argv)
+
+
+# Configures the environment before the app modules are imported, since they
+# read their settings at import time
+def configure_environment(openai_fake, tmdb_fake, db_path):
+    os.environ.setdefault('CHATGPT_KEY', 'bench')
+    os.environ.setdefault('TMDB_API_KEY', 'bench')
+    os.environ.setdefault('TMDB_ACCESS_TOKEN', 'bench')
+    os.environ['OPENAI_API_BASE'] = f"{openai_fake.url}/v1"
+    os.environ['TMDB_API_URL'] = tmdb_fake.url
+    os.environ['DATABASE_URL'] = f"sqlite:///{db_path}"
+    # The harness drives every request from one address
+    os.environ.setdefault('RATE_LIMIT_RATE', '0')
+
+
+def make_queries(count):
+    queries = []
+    for _ in range(count):
+        queries.append({
+            "movie": random.choice(MOVIES),
+            "genres": random.sample(GENRES, 2),
+            "moods": random.sample(MOODS, 1),
+            "streaming_services": random.sample(SERVICES, 1),
+        })
+    return queries
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+# Waits for background work (prefetches, then the pool refills they can feed)
+# and drops the pools, prefetch sessions and cached posters, so each route
+# starts cold and isn't credited with, or charged for, another route's work
+def reset_app_state():
+    from app.poster_cache import poster_cache
+    from app.prefetch import page_prefetcher
+    from app.recommendation_pool import recommendation_pool
+    page_prefetcher.reset()
+    recommendation_pool.reset()
+    poster_cache.invalidate()
+
+
+def run_route(app, route, queries, args, openai_fake, tmdb_fake):
+    reset_app_state()
+    openai_fake.reset()
+    tmdb_fake.reset()
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one_request(index):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        query = queries[index % len(queries)]
+        headers = {'X-Client-Id': f"bench-{index % args.concurrency}"}
+        start = time.perf_counter()
+        if route == 'api':
+            response = client.post('/api/recommendations', json=query, headers=headers)
+            ok = response.status_code == 200
+        else:
+            form = {
+                'movie': query['movie'],
+                'genres': ','.join(query['genres']),
+                'moods': ','.join(query['moods']),
+                'streaming_services': ','.join(query['streaming_services']),
+            }
+            response = client.post('/api/form/recommendations', data=form, headers=headers)
+            ok = response.status_code == 200 and b'class="recommendation"' in response.data
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                failures[0] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one_request, range(args.requests)))
+    duration = time.perf_counter() - start
+    # Upstream calls made by this route's background work count towards it
+    reset_app_state()
+
+    return {
+        "requests": args.requests,
+        "failures": failures[0],
+        "throughput_rps": args.requests / duration if duration else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "openai_calls_per_request": openai_fake.calls / args.requests,
+        "tmdb_calls_per_request": tmdb_fake.calls / args.requests,
+    }
+
+
+# Returns a list of human-readable regressions against the baseline
+def compare(results, baseline, tolerance):
+    regressions = []
+    for route, current in results.items():
+        previous = baseline.get(route)
+        if not previous:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'openai_calls_per_request', 'tmdb_calls_per_request'):
+            if previous[key] and current[key] > previous[key] * (1 + tolerance):
+                regressions.append(f"{route} {key}: {previous[key]:.2f} -> {current[key]:.2f}")
+        if current['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{route} throughput_rps: {previous['throughput_rps']:.2f} -> {current['throughput_rps']:.2f}")
+        if current['failures'] > previous['failures']:
+            regressions.append(f"{route} failures: {previous['failures']} -> {current['failures']}")
+    return regressions
+
+
+def print_results(results):
+    columns = ('requests', 'failures', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'openai_calls_per_request', 'tmdb_calls_per_request')
+    for route, result in results.items():
+        print(f"[{route}]")
+        for column in columns:
+            value = result[column]
+            print(f"  {column:26} {value:.2f}" if isinstance(value, float) else f"  {column:26} {value}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+
+    openai_fake = FakeOpenAI(Latency(args.openai_latency_ms, args.openai_latency_sigma), args.openai_error_rate, args.malformed_rate).start()
+    tmdb_fake = FakeTMDB(Latency(args.tmdb_latency_ms, args.tmdb_latency_sigma), args.tmdb_error_rate).start()
+    db_dir = tempfile.mkdtemp(prefix='bench-')
+    configure_environment(openai_fake, tmdb_fake, os.path.join(db_dir, 'bench.db'))
+
+    import openai
+    from flask_migrate import upgrade
+    from app import create_app
+    openai.api_base = os.environ['OPENAI_API_BASE']
+    app = create_app()
+    with app.app_context():
+        upgrade(directory=MIGRATIONS_DIR)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    queries = make_queries(args.distinct_queries)
+    results = {}
+    try:
+        for route in [route.strip() for route in args.routes.split(',') if route.strip()]:
+            results[route] = run_route(app, route, queries, args, openai_fake, tmdb_fake)
+    finally:
+        openai_fake.stop()
+        tmdb_fake.stop()
+
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against (run with --save-baseline)")
+        return 0
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    if regressions:
+        print("Regressions against baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("No regressions against baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,4 +12,94 @@ class Config():
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     OPEN_API_KEY = os.environ.get('OPEN_API_KEY')
 
+    # TMDB poster lookups
+    TMDB_API_URL = os.environ.get('TMDB_API_URL') or 'https://api.themoviedb.org/3'
+    TMDB_TIMEOUT = float(os.environ.get('TMDB_TIMEOUT') or 3)
+    TMDB_DEADLINE = float(os.environ.get('TMDB_DEADLINE') or 4)
+    TMDB_POOL_SIZE = int(os.environ.get('TMDB_POOL_SIZE') or 10)
 
+    # Poster cache: in-process LRU in front of the poster_cache table
+    POSTER_CACHE_SIZE = int(os.environ.get('POSTER_CACHE_SIZE') or 2048)
+    POSTER_CACHE_TTL = int(os.environ.get('POSTER_CACHE_TTL') or 7 * 24 * 3600)
+    POSTER_CACHE_NEGATIVE_TTL = int(os.environ.get('POSTER_CACHE_NEGATIVE_TTL') or 24 * 3600)
+    # How long a worker trusts its in-memory copy before re-reading the row;
+    # bounds how long an invalidation takes to reach running workers
+    POSTER_CACHE_MEMORY_TTL = int(os.environ.get('POSTER_CACHE_MEMORY_TTL') or 300)
+
+    # Pre-generated recommendation pools per normalized query
+    RECOMMENDATION_POOL_ENABLED = (os.environ.get('RECOMMENDATION_POOL_ENABLED') or 'true').lower() == 'true'
+    RECOMMENDATION_POOL_MAX_SIZE = int(os.environ.get('RECOMMENDATION_POOL_MAX_SIZE') or 30)
+    RECOMMENDATION_POOL_LOW_WATER = int(os.environ.get('RECOMMENDATION_POOL_LOW_WATER') or 6)
+    RECOMMENDATION_POOL_MAX_QUERIES = int(os.environ.get('RECOMMENDATION_POOL_MAX_QUERIES') or 500)
+    RECOMMENDATION_POOL_MAX_AGE = int(os.environ.get('RECOMMENDATION_POOL_MAX_AGE') or 6 * 3600)
+    RECOMMENDATION_POOL_MAX_CLIENTS = int(os.environ.get('RECOMMENDATION_POOL_MAX_CLIENTS') or 1000)
+    RECOMMENDATION_POOL_WORKERS = int(os.environ.get('RECOMMENDATION_POOL_WORKERS') or 2)
+
+    # 'text' parses labeled lines; 'json' asks the model for a function-call schema
+    RECOMMENDATIONS_MODE = (os.environ.get('RECOMMENDATIONS_MODE') or 'text').lower()
+    RECOMMENDATIONS_MAX_MODEL_CALLS = int(os.environ.get('RECOMMENDATIONS_MAX_MODEL_CALLS') or 3)
+
+    # Shared connection pool for the async (aiohttp) request path
+    ASYNC_HTTP_POOL_SIZE = int(os.environ.get('ASYNC_HTTP_POOL_SIZE') or 100)
+
+    # Single-flight coalescing of identical in-flight upstream calls. Set
+    # SINGLEFLIGHT_DB to a SQLite path to coalesce across gunicorn workers too.
+    SINGLEFLIGHT_TIMEOUT = float(os.environ.get('SINGLEFLIGHT_TIMEOUT') or 60)
+    SINGLEFLIGHT_DB = os.environ.get('SINGLEFLIGHT_DB')
+    SINGLEFLIGHT_POLL_INTERVAL = float(os.environ.get('SINGLEFLIGHT_POLL_INTERVAL') or 0.05)
+
+    # POST /api/recommendations/batch
+    BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS') or 50)
+    BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY') or 8)
+
+    # Local movie catalog used to prefilter candidates before a GPT re-rank
+    CATALOG_ENABLED = (os.environ.get('CATALOG_ENABLED') or 'true').lower() == 'true'
+    CATALOG_MAX_CANDIDATES = int(os.environ.get('CATALOG_MAX_CANDIDATES') or 25)
+    CATALOG_MIN_CANDIDATES = int(os.environ.get('CATALOG_MIN_CANDIDATES') or 6)
+    CATALOG_WATCH_REGION = os.environ.get('CATALOG_WATCH_REGION') or 'US'
+    CATALOG_RETRY_SECONDS = float(os.environ.get('CATALOG_RETRY_SECONDS') or 60)
+
+    # Speculative prefetch of the next "more recommendations" page per client
+    PREFETCH_ENABLED = (os.environ.get('PREFETCH_ENABLED') or 'true').lower() == 'true'
+    PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS') or 4)
+    PREFETCH_MAX_SESSIONS = int(os.environ.get('PREFETCH_MAX_SESSIONS') or 1000)
+    PREFETCH_MAX_SHOWN = int(os.environ.get('PREFETCH_MAX_SHOWN') or 60)
+    PREFETCH_TTL = int(os.environ.get('PREFETCH_TTL') or 600)
+    PREFETCH_WAIT = float(os.environ.get('PREFETCH_WAIT') or 30)
+
+    # Upstream call layer: per-attempt timeouts, overall deadlines, retries,
+    # hedging after the observed latency percentile, and circuit breakers
+    OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT') or 30)
+    OPENAI_DEADLINE = float(os.environ.get('OPENAI_DEADLINE') or 60)
+    OPENAI_RETRIES = int(os.environ.get('OPENAI_RETRIES') or 2)
+    OPENAI_HEDGE = (os.environ.get('OPENAI_HEDGE') or 'true').lower() == 'true'
+    OPENAI_HEDGE_DELAY = float(os.environ.get('OPENAI_HEDGE_DELAY') or 10)
+    TMDB_RETRIES = int(os.environ.get('TMDB_RETRIES') or 1)
+    TMDB_HEDGE = (os.environ.get('TMDB_HEDGE') or 'true').lower() == 'true'
+    TMDB_HEDGE_DELAY = float(os.environ.get('TMDB_HEDGE_DELAY') or 0.5)
+    UPSTREAM_HEDGE_PERCENTILE = float(os.environ.get('UPSTREAM_HEDGE_PERCENTILE') or 95)
+    UPSTREAM_BREAKER_FAILURES = int(os.environ.get('UPSTREAM_BREAKER_FAILURES') or 5)
+    UPSTREAM_BREAKER_RESET = float(os.environ.get('UPSTREAM_BREAKER_RESET') or 30)
+
+    # Admission control for the recommendation routes: a token bucket per
+    # client (RATE_LIMIT_RATE requests/second, bursts of RATE_LIMIT_BURST; off
+    # by default; batch items count one each), at most
+    # ADMISSION_MAX_CONCURRENT generations at once, counting batch items, pool
+    # refills and prefetches, and a wait queue of ADMISSION_MAX_QUEUE. Set
+    # ADMISSION_DB to a SQLite path to share the limits across gunicorn workers.
+    ADMISSION_ENABLED = (os.environ.get('ADMISSION_ENABLED') or 'true').lower() == 'true'
+    ADMISSION_DB = os.environ.get('ADMISSION_DB')
+    ADMISSION_API_KEY_HEADER = os.environ.get('ADMISSION_API_KEY_HEADER') or 'X-Api-Key'
+    RATE_LIMIT_RATE = float(os.environ.get('RATE_LIMIT_RATE') or 0)
+    RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST') or 10)
+    ADMISSION_MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT') or 64)
+    ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE') or 128)
+    ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT') or 10)
+    ADMISSION_DEFAULT_HOLD = float(os.environ.get('ADMISSION_DEFAULT_HOLD') or 5)
+    ADMISSION_SLOT_TTL = float(os.environ.get('ADMISSION_SLOT_TTL') or 120)
+    ADMISSION_POLL_INTERVAL = float(os.environ.get('ADMISSION_POLL_INTERVAL') or 0.05)
+
+    # Number of reverse proxies in front of the app that set X-Forwarded-For.
+    # Clients are rate limited by the address those proxies report; leave at 0
+    # when clients connect directly, or they could pick their own address.
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR') or 0)
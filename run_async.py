@@ -0,0 +1,16 @@
+# Async entry point for the recommendation routes. Serve it with:
+#   gunicorn run_async:app --worker-class aiohttp.GunicornWebWorker
+# This is a reduced front end: first pages only, without the recommendation
+# pool, "more recommendations" paging, streaming or batch routes (see
+# app/async_api.py). Deploy run.py for the full API.
+from aiohttp import web
+from app import create_app
+from app.async_api import create_async_app
+import logging
+
+flask_app = create_app()
+app = create_async_app(flask_app)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    web.run_app(app)
@@ -0,0 +1,5 @@
+import os
+
+# app.recommendations refuses to import without its API keys; tests never call the real APIs
+for name in ('CHATGPT_KEY', 'TMDB_API_KEY', 'TMDB_ACCESS_TOKEN'):
+    os.environ.setdefault(name, 'test')
@@ -0,0 +1,227 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from config import Config
+from app.admission import AdmissionController, AdmissionRejected, LocalAdmissionBackend, SQLiteAdmissionBackend
+
+
+@pytest.fixture(params=['local', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'local':
+        return LocalAdmissionBackend()
+    return SQLiteAdmissionBackend(str(tmp_path / 'admission.db'))
+
+
+@pytest.fixture(autouse=True)
+def config(monkeypatch):
+    monkeypatch.setattr(Config, 'ADMISSION_ENABLED', True)
+    monkeypatch.setattr(Config, 'ADMISSION_MAX_CONCURRENT', 1)
+    monkeypatch.setattr(Config, 'ADMISSION_MAX_QUEUE', 4)
+    monkeypatch.setattr(Config, 'ADMISSION_QUEUE_TIMEOUT', 5)
+    monkeypatch.setattr(Config, 'ADMISSION_DEFAULT_HOLD', 0.1)
+    monkeypatch.setattr(Config, 'ADMISSION_SLOT_TTL', 120)
+    monkeypatch.setattr(Config, 'ADMISSION_POLL_INTERVAL', 0.005)
+    monkeypatch.setattr(Config, 'RATE_LIMIT_RATE', 1)
+    monkeypatch.setattr(Config, 'RATE_LIMIT_BURST', 2)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+# Queues an acquire in a thread; its token lands in tokens[name] once admitted
+def queue_waiter(controller, name, tokens, errors):
+    def run():
+        try:
+            tokens[name] = controller.acquire()
+        except AdmissionRejected as rejected:
+            errors[name] = rejected
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_waiters_are_admitted_in_arrival_order(backend):
+    controller = AdmissionController(backend)
+    held = controller.acquire()
+    tokens, errors = {}, {}
+    threads = []
+    for count, name in enumerate(['first', 'second', 'third'], 1):
+        threads.append(queue_waiter(controller, name, tokens, errors))
+        wait_until(lambda: backend.counts()['waiting'] == count)
+
+    controller.release(held)
+    wait_until(lambda: 'first' in tokens)
+    time.sleep(0.05)
+    assert list(tokens) == ['first']
+
+    controller.release(tokens['first'])
+    wait_until(lambda: 'second' in tokens)
+    time.sleep(0.05)
+    assert list(tokens) == ['first', 'second']
+
+    controller.release(tokens['second'])
+    wait_until(lambda: 'third' in tokens)
+    controller.release(tokens['third'])
+    for thread in threads:
+        thread.join()
+    assert errors == {}
+    assert backend.counts()['active'] == 0
+
+
+def test_burst_takes_free_slots_without_queueing(backend, monkeypatch):
+    monkeypatch.setattr(Config, 'ADMISSION_MAX_CONCURRENT', 8)
+    monkeypatch.setattr(Config, 'ADMISSION_MAX_QUEUE', 2)
+    controller = AdmissionController(backend)
+    start = threading.Barrier(10)
+    tokens, errors = {}, {}
+
+    def run(name):
+        start.wait()
+        try:
+            tokens[name] = controller.acquire()
+        except AdmissionRejected as rejected:
+            errors[name] = rejected
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in range(10)]
+    for thread in threads:
+        thread.start()
+    # 8 take a slot straight away; only the other 2 wait, which the queue holds
+    wait_until(lambda: len(tokens) == 8 and backend.counts()['waiting'] == 2)
+    assert errors == {}
+
+    first = dict(tokens)
+    for token in first.values():
+        controller.release(token)
+    wait_until(lambda: len(tokens) == 10)
+    for thread in threads:
+        thread.join()
+    for name, token in tokens.items():
+        if name not in first:
+            controller.release(token)
+    assert errors == {}
+    assert backend.counts()['active'] == 0
+
+
+def test_sheds_when_the_queue_is_full(backend, monkeypatch):
+    monkeypatch.setattr(Config, 'ADMISSION_MAX_QUEUE', 1)
+    controller = AdmissionController(backend)
+    held = controller.acquire()
+    tokens, errors = {}, {}
+    thread = queue_waiter(controller, 'queued', tokens, errors)
+    wait_until(lambda: backend.counts()['waiting'] == 1)
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire()
+    assert (rejected.value.status, rejected.value.reason) == (503, 'queue_full')
+    assert rejected.value.retry_after >= 1
+
+    controller.release(held)
+    thread.join()
+    controller.release(tokens['queued'])
+    assert controller.stats()['queue_full'] == 1
+
+
+def test_sheds_straight_away_when_the_wait_would_outlast_the_deadline(backend, monkeypatch):
+    monkeypatch.setattr(Config, 'ADMISSION_QUEUE_TIMEOUT', 1)
+    monkeypatch.setattr(Config, 'ADMISSION_DEFAULT_HOLD', 5)
+    controller = AdmissionController(backend)
+    held = controller.acquire()
+
+    start = time.perf_counter()
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire()
+    assert time.perf_counter() - start < 0.5
+    assert (rejected.value.status, rejected.value.reason, rejected.value.retry_after) == (503, 'deadline', 5)
+    # The shed request left the queue
+    assert backend.counts()['waiting'] == 0
+    controller.release(held)
+
+
+def test_sheds_a_waiter_at_its_queue_timeout(backend, monkeypatch):
+    monkeypatch.setattr(Config, 'ADMISSION_QUEUE_TIMEOUT', 0.05)
+    monkeypatch.setattr(Config, 'ADMISSION_DEFAULT_HOLD', 0.01)
+    controller = AdmissionController(backend)
+    held = controller.acquire()
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire()
+    assert rejected.value.reason == 'timeout'
+    assert backend.counts()['waiting'] == 0
+    controller.release(held)
+
+
+def test_background_work_only_takes_a_free_slot_nobody_is_waiting_for(backend):
+    controller = AdmissionController(backend)
+    held = controller.acquire()
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire(background=True)
+    assert rejected.value.reason == 'background'
+    controller.release(held)
+
+    # A free slot with a request queued for it
+    backend.enqueue('waiting', Config.ADMISSION_MAX_QUEUE)
+    with pytest.raises(AdmissionRejected):
+        controller.acquire(background=True)
+    backend.dequeue('waiting')
+
+    token = controller.acquire(background=True)
+    assert backend.counts()['active'] == 1
+    controller.release(token)
+
+
+def test_slot_is_released_when_the_generation_fails(backend):
+    controller = AdmissionController(backend)
+    with pytest.raises(ValueError):
+        with controller.slot():
+            assert backend.counts()['active'] == 1
+            raise ValueError("No valid recommendations")
+    assert backend.counts()['active'] == 0
+
+
+def test_async_slot_waits_for_a_free_slot(backend):
+    controller = AdmissionController(backend)
+
+    async def main():
+        held = controller.acquire()
+        waiter = asyncio.ensure_future(controller.acquire_async())
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        controller.release(held)
+        controller.release(await asyncio.wait_for(waiter, 5))
+        async with controller.slot_async():
+            assert backend.counts()['active'] == 1
+
+    asyncio.run(main())
+    assert backend.counts()['active'] == 0
+
+
+def test_rate_limit_is_per_client(backend):
+    controller = AdmissionController(backend)
+    controller.check_rate('ip:a')
+    controller.check_rate('ip:a')
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.check_rate('ip:a')
+    assert (rejected.value.status, rejected.value.reason, rejected.value.retry_after) == (429, 'rate_limited', 1)
+    controller.check_rate('ip:b')
+
+
+def test_rate_limit_is_off_at_zero(backend, monkeypatch):
+    monkeypatch.setattr(Config, 'RATE_LIMIT_RATE', 0)
+    controller = AdmissionController(backend)
+    for _ in range(10):
+        controller.check_rate('ip:a')
+
+
+def test_disabled_admission_lets_everything_through(backend, monkeypatch):
+    monkeypatch.setattr(Config, 'ADMISSION_ENABLED', False)
+    controller = AdmissionController(backend)
+    assert [controller.acquire() for _ in range(3)] == [None] * 3
+    assert backend.counts()['active'] == 0
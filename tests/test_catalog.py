@@ -0,0 +1,38 @@
+import threading
+import time
+
+from app.catalog import MovieCatalog
+
+
+class CountingCatalog(MovieCatalog):
+    def __init__(self, result):
+        super().__init__()
+        self.result = result
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        time.sleep(0.02)
+        self.loaded = self.result
+        return self.result
+
+
+def test_concurrent_first_requests_load_once():
+    catalog = CountingCatalog(True)
+    threads = [threading.Thread(target=catalog.ensure_loaded) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert catalog.loads == 1
+
+
+def test_failed_load_is_not_retried_until_the_backoff_passes():
+    catalog = CountingCatalog(False)
+    catalog.ensure_loaded()
+    catalog.ensure_loaded()
+    assert catalog.loads == 1
+
+    catalog.retry_at = 0
+    catalog.ensure_loaded()
+    assert catalog.loads == 2
@@ -0,0 +1,24 @@
+import time
+
+from app.poster_cache import PosterCache
+
+
+def test_memory_entries_expire_after_the_memory_ttl():
+    cache = PosterCache()
+    cache.memory_ttl = 0.05
+    cache.set('Heat', 1995, 'https://image.tmdb.org/t/p/w500/heat.jpg')
+    assert cache.get('Heat', 1995) == (True, 'https://image.tmdb.org/t/p/w500/heat.jpg')
+
+    time.sleep(0.06)
+    # Without an app there's no row to re-read, so the lookup misses
+    assert cache.get('Heat', 1995) == (False, None)
+
+
+def test_memory_ttl_does_not_extend_the_entry_ttl():
+    cache = PosterCache()
+    cache.negative_ttl = 0.05
+    cache.set('Unknown Film', None, None)
+    assert cache.get('Unknown Film') == (True, None)
+
+    time.sleep(0.06)
+    assert cache.get('Unknown Film') == (False, None)
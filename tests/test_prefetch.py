@@ -0,0 +1,114 @@
+import itertools
+import threading
+
+import pytest
+
+from config import Config
+from app import prefetch, recommendation_pool as pool_module
+from app.prefetch import PagePrefetcher
+from app.recommendation_pool import RecommendationPool
+
+QUERY = ('Heat', ['drama'], [], ['netflix'])
+
+
+# Stands in for get_recommendations: new titles on every call, never an excluded one
+class FakeGenerator:
+    def __init__(self):
+        self.titles = (f"Movie {n}" for n in itertools.count())
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, movie=None, genres=None, moods=None, streaming_services=None, exclude=None, usage=None, count=3, background=False):
+        with self.lock:
+            self.calls.append({'exclude': set(exclude or []), 'background': background})
+            return [{'title': next(self.titles)} for _ in range(count)]
+
+
+@pytest.fixture
+def generator(monkeypatch):
+    generator = FakeGenerator()
+    monkeypatch.setattr(pool_module, 'get_recommendations', generator)
+    monkeypatch.setattr(prefetch, 'get_recommendations', generator)
+    return generator
+
+
+@pytest.fixture
+def pool(monkeypatch, generator):
+    pool = RecommendationPool()
+    monkeypatch.setattr(prefetch, 'recommendation_pool', pool)
+    yield pool
+    pool.reset()
+
+
+@pytest.fixture
+def prefetcher(monkeypatch, pool):
+    monkeypatch.setattr(Config, 'PREFETCH_ENABLED', True)
+    monkeypatch.setattr(Config, 'PREFETCH_WAIT', 5)
+    prefetcher = PagePrefetcher()
+    yield prefetcher
+    prefetcher.reset()
+
+
+def titles(recommendations):
+    return [rec['title'] for rec in recommendations]
+
+
+def test_more_pages_never_repeat_a_title(pool, prefetcher):
+    first = pool.take(*QUERY, client_id='a')
+    prefetcher.start('a', QUERY, first)
+    pages = [first] + [prefetcher.next_page('a', QUERY) for _ in range(8)]
+
+    shown = [title for page in pages for title in titles(page)]
+    assert [len(page) for page in pages] == [3] * 9
+    assert len(set(shown)) == len(shown)
+
+
+def test_pooled_pages_are_served_without_generating(pool, prefetcher, generator):
+    pool.low_water = 0
+    pool.remember(*QUERY, recommendations=[{'title': f"Pooled {n}"} for n in range(12)])
+
+    first = pool.take(*QUERY, client_id='b')
+    prefetcher.start('b', QUERY, first)
+    pages = [first] + [prefetcher.next_page('b', QUERY) for _ in range(2)]
+
+    assert [titles(page) for page in pages] == [[f"Pooled {n}" for n in range(start, start + 3)] for start in (0, 3, 6)]
+    assert generator.calls == []
+    assert prefetcher.stats()['prefetched'] == 0
+    assert prefetcher.stats()['pool_hits'] == 2
+
+
+def test_abandoned_prefetch_goes_into_the_pool(pool, prefetcher, generator):
+    pool.low_water = 0
+    pool.remember(*QUERY, recommendations=[{'title': f"Pooled {n}"} for n in range(3)])
+    first = pool.take(*QUERY, client_id='a')
+    # The pool can't cover a's next page, so it's prefetched
+    prefetcher.start('a', QUERY, first)
+    assert prefetcher.stats()['prefetched'] == 1
+    # Client a never asks for it
+    prefetcher.reset()
+
+    page = pool.take(*QUERY, client_id='b')
+    assert len(page) == 3
+    assert generator.calls == [{'exclude': set(titles(first)), 'background': True}]
+
+
+def test_prefetch_excludes_what_the_client_has_seen(pool, prefetcher, generator, monkeypatch):
+    monkeypatch.setattr(pool, 'enabled', False)
+    first = pool.take(*QUERY, client_id='a')
+    prefetcher.start('a', QUERY, first)
+    second = prefetcher.next_page('a', QUERY)
+
+    assert set(titles(first)).isdisjoint(titles(second))
+    prefetch_call = generator.calls[1]
+    assert prefetch_call['background']
+    assert prefetch_call['exclude'] == set(titles(first))
+
+
+def test_coalesced_follower_tops_up_titles_it_has_seen(generator, monkeypatch):
+    shared = [{'title': 'Heat'}, {'title': 'Zodiac'}, {'title': 'Arrival'}]
+    monkeypatch.setattr(pool_module.recommendation_flights, 'do', lambda key, fn: shared)
+
+    page = pool_module.get_recommendations_coalesced(*QUERY, exclude=['Heat'])
+
+    assert titles(page) == ['Zodiac', 'Arrival', 'Movie 0']
+    assert generator.calls == [{'exclude': {'Heat', 'Zodiac', 'Arrival'}, 'background': False}]
@@ -0,0 +1,22 @@
+import pytest
+
+from app.recommendations import RECOMMENDATION_FUNCTION, parse_structured_recommendation, recommendation_function
+
+
+def required_fields(function):
+    return function['parameters']['properties']['recommendations']['items']['required']
+
+
+def test_schema_requires_similarity_only_with_a_seed_movie():
+    assert 'similarity' not in required_fields(recommendation_function(False))
+    assert {'similarity', 'explanation'} <= set(required_fields(recommendation_function(True)))
+    # The shared base schema isn't modified
+    assert 'similarity' not in required_fields(RECOMMENDATION_FUNCTION)
+
+
+def test_structured_recommendation_without_similarity():
+    rec = {'title': 'Heat', 'year': '1995', 'runtime': '170', 'streaming_service': 'Netflix', 'synopsis': 'A heist.'}
+    with pytest.raises(ValueError):
+        parse_structured_recommendation(rec, require_similarity=True)
+    details = parse_structured_recommendation(rec, require_similarity=False)
+    assert (details['similarity'], details['explanation']) == ("N/A", "No explanation provided.")
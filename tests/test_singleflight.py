@@ -0,0 +1,244 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from app.admission import AdmissionRejected
+from app.singleflight import AsyncSingleFlight, SharedFlightStore, SingleFlight, SingleFlightError, SingleFlightTimeout
+
+
+# Starts a leader call that blocks until release is set, and waits until it holds the flight
+def start_leader(flights, key, fn):
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = flights.do(key, fn)
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    while key not in flights.flights:
+        time.sleep(0.001)
+    return thread, outcome
+
+
+def test_waiters_share_the_leaders_result():
+    flights = SingleFlight('test', timeout=5)
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return ['Heat']
+
+    leader, outcome = start_leader(flights, 'key', fn)
+    results = []
+    waiters = [threading.Thread(target=lambda: results.append(flights.do('key', fn))) for _ in range(3)]
+    for waiter in waiters:
+        waiter.start()
+    while flights.flights['key'].waiters < 3:
+        time.sleep(0.001)
+    release.set()
+    leader.join()
+    for waiter in waiters:
+        waiter.join()
+
+    assert outcome['result'] == ['Heat']
+    assert results == [['Heat']] * 3
+    assert len(calls) == 1
+    assert flights.stats() == {'leaders': 1, 'shared': 3, 'timeouts': 0, 'in_flight': 0}
+
+
+def test_waiters_get_the_leaders_error():
+    flights = SingleFlight('test', timeout=5)
+    release = threading.Event()
+    error = ValueError("upstream failed")
+
+    def fn():
+        release.wait(5)
+        raise error
+
+    leader, outcome = start_leader(flights, 'key', fn)
+    errors = []
+
+    def wait():
+        try:
+            flights.do('key', fn)
+        except ValueError as e:
+            errors.append(e)
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    while flights.flights['key'].waiters < 1:
+        time.sleep(0.001)
+    release.set()
+    leader.join()
+    waiter.join()
+
+    assert outcome['error'] is error
+    assert errors == [error]
+    # A failed flight isn't remembered; the next call runs again
+    assert flights.do('key', lambda: 'retried') == 'retried'
+
+
+def test_waiter_times_out_without_cancelling_the_leader():
+    flights = SingleFlight('test', timeout=5)
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        return 'done'
+
+    leader, outcome = start_leader(flights, 'key', fn)
+    with pytest.raises(SingleFlightTimeout):
+        flights.do('key', fn, timeout=0.05)
+    release.set()
+    leader.join()
+
+    assert outcome['result'] == 'done'
+    assert flights.stats()['timeouts'] == 1
+
+
+# Two stores on one file stand in for two gunicorn workers
+@pytest.fixture
+def stores(tmp_path):
+    path = str(tmp_path / 'flights.db')
+    return SharedFlightStore(path, poll_interval=0.005), SharedFlightStore(path, poll_interval=0.005)
+
+
+def run_in_thread(fn):
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = fn()
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def test_shared_store_waiter_gets_the_other_workers_result(stores):
+    first, second = stores
+    started, release = threading.Event(), threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        return [{'title': 'Heat'}]
+
+    leader, outcome = run_in_thread(lambda: first.run('recommendations:key', fn, 5))
+    started.wait(5)
+    waiter, waited = run_in_thread(lambda: second.run('recommendations:key', lambda: pytest.fail("ran twice"), 5))
+    time.sleep(0.02)
+    release.set()
+    leader.join()
+    waiter.join()
+
+    assert outcome['result'] == [{'title': 'Heat'}]
+    assert waited['result'] == [{'title': 'Heat'}]
+
+
+def test_shared_store_waiter_gets_the_other_workers_error(stores):
+    first, second = stores
+    started, release = threading.Event(), threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        raise ValueError("No valid recommendations")
+
+    leader, outcome = run_in_thread(lambda: first.run('recommendations:key', fn, 5))
+    started.wait(5)
+    waiter, waited = run_in_thread(lambda: second.run('recommendations:key', lambda: pytest.fail("ran twice"), 5))
+    time.sleep(0.02)
+    release.set()
+    leader.join()
+    waiter.join()
+
+    assert isinstance(outcome['error'], ValueError)
+    assert isinstance(waited['error'], SingleFlightError)
+    assert str(waited['error']) == "No valid recommendations"
+
+
+def test_shared_store_waiter_times_out(stores):
+    first, second = stores
+    started, release = threading.Event(), threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        return []
+
+    leader, outcome = run_in_thread(lambda: first.run('recommendations:key', fn, 5))
+    started.wait(5)
+    try:
+        with pytest.raises(SingleFlightTimeout):
+            second.run('recommendations:key', lambda: pytest.fail("ran twice"), 0.05)
+    finally:
+        release.set()
+        leader.join()
+    assert outcome['result'] == []
+
+
+def test_shared_store_late_waiter_still_gets_its_leaders_result(tmp_path):
+    path = str(tmp_path / 'flights.db')
+    first, second, third = (SharedFlightStore(path, poll_interval=0.005) for _ in range(3))
+
+    assert first._claim('k', 'a', 5) == (True, 'a')
+    assert second._claim('k', 'b', 5) == (False, 'a')
+    first._finish('k', 'a', result=json.dumps('A'))
+    # A newer call for the key starts before the waiter polls
+    assert third._claim('k', 'c', 5) == (True, 'c')
+
+    assert second._wait('k', 'a', 5) == 'A'
+
+
+def test_shared_store_waiter_gets_the_leaders_admission_rejection(stores):
+    first, second = stores
+    started, release = threading.Event(), threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        raise AdmissionRejected(503, 'queue_full', 7)
+
+    leader, outcome = run_in_thread(lambda: first.run('recommendations:key', fn, 5))
+    started.wait(5)
+    waiter, waited = run_in_thread(lambda: second.run('recommendations:key', lambda: pytest.fail("ran twice"), 5))
+    time.sleep(0.02)
+    release.set()
+    leader.join()
+    waiter.join()
+
+    error = waited['error']
+    assert isinstance(error, AdmissionRejected)
+    assert (error.status, error.reason, error.retry_after) == (503, 'queue_full', 7)
+
+
+def test_async_waiter_timeout_does_not_cancel_the_call():
+    flights = AsyncSingleFlight('test', timeout=5)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def fn():
+            await release.wait()
+            return 'done'
+
+        leader = asyncio.ensure_future(flights.do('key', fn))
+        await asyncio.sleep(0)
+        with pytest.raises(SingleFlightTimeout):
+            await flights.do('key', fn, timeout=0.01)
+        release.set()
+        return await leader
+
+    assert asyncio.run(main()) == 'done'
+    assert flights.stats() == {'leaders': 1, 'shared': 1, 'timeouts': 1, 'in_flight': 0}
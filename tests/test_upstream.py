@@ -0,0 +1,192 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.upstream import CircuitBreaker, CircuitOpenError, DeadlineExceeded, Upstream
+
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+
+def failing(error):
+    def fn():
+        raise error
+    return fn
+
+
+def make_upstream(**kwargs):
+    options = dict(deadline=2, retries=0, backoff=0.001, hedge=False, failure_threshold=2, reset_timeout=0.05)
+    options.update(kwargs)
+    return Upstream('test', **options)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_breaker_success_resets_the_failure_count():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+
+def test_breaker_lets_one_probe_through_when_half_open():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.allow()
+    assert breaker.state == 'half_open'
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_breaker_closes_after_a_successful_probe():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    breaker.allow()
+    breaker.allow()
+
+
+def test_breaker_reopens_after_a_failed_probe():
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=0.05)
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_call_fails_fast_while_open_and_recovers():
+    upstream = make_upstream()
+    for _ in range(2):
+        with pytest.raises(HTTPError):
+            upstream.call(failing(HTTPError(503)))
+    calls = []
+    with pytest.raises(CircuitOpenError):
+        upstream.call(lambda: calls.append(1))
+    assert calls == []
+    assert upstream.stats()['rejected'] == 1
+
+    time.sleep(0.06)
+    assert upstream.call(lambda: 'ok') == 'ok'
+    assert upstream.breaker.state == 'closed'
+
+
+def test_retries_retryable_errors():
+    upstream = make_upstream(retries=2)
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise HTTPError(503)
+        return 'ok'
+
+    assert upstream.call(fn) == 'ok'
+    assert len(attempts) == 3
+    assert upstream.stats()['retries'] == 2
+    assert upstream.breaker.state == 'closed'
+
+
+def test_errors_rejected_by_retry_if_are_not_retried_and_do_not_trip_the_breaker():
+    upstream = make_upstream(retries=2, failure_threshold=1, retry_if=lambda e: e.status >= 500 or e.status == 429)
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        raise HTTPError(404)
+
+    with pytest.raises(HTTPError):
+        upstream.call(fn)
+    assert len(attempts) == 1
+    assert upstream.breaker.state == 'closed'
+
+    with pytest.raises(HTTPError):
+        upstream.call(failing(HTTPError(429)))
+    assert upstream.breaker.state == 'open'
+
+
+def test_deadline_is_enforced_and_counts_as_a_failure():
+    upstream = make_upstream(deadline=0.05, failure_threshold=1)
+    release = threading.Event()
+    start = time.perf_counter()
+    with pytest.raises(DeadlineExceeded):
+        upstream.call(lambda: release.wait(5))
+    release.set()
+    assert time.perf_counter() - start < 1
+    assert upstream.breaker.state == 'open'
+
+
+def test_slow_call_is_hedged_and_the_faster_request_wins():
+    upstream = make_upstream(hedge=True, hedge_min_delay=0.02, hedge_default_delay=0.02)
+    release = threading.Event()
+    attempts = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            attempts.append(1)
+            first = len(attempts) == 1
+        if first:
+            release.wait(5)
+            return 'primary'
+        return 'hedge'
+
+    try:
+        assert upstream.call(fn) == 'hedge'
+    finally:
+        release.set()
+    assert upstream.stats()['hedges'] == 1
+    assert upstream.stats()['hedge_wins'] == 1
+
+
+def test_call_async_retries_and_opens_the_breaker():
+    upstream = make_upstream(retries=1)
+    attempts = []
+
+    async def fn():
+        attempts.append(1)
+        raise HTTPError(502)
+
+    async def main():
+        for _ in range(2):
+            with pytest.raises(HTTPError):
+                await upstream.call_async(fn)
+        with pytest.raises(CircuitOpenError):
+            await upstream.call_async(fn)
+
+    asyncio.run(main())
+    assert len(attempts) == 4
+    assert upstream.breaker.state == 'open'
+
+
+def test_latency_is_tracked_per_kind_and_only_for_hedged_calls():
+    upstream = make_upstream(hedge=True, hedge_default_delay=5)
+    upstream.call(lambda: time.sleep(0.01), kind='rerank')
+    upstream.call(lambda: 'streamed', hedge=False, kind='stream')
+
+    assert len(upstream._tracker('rerank').samples) == 1
+    assert len(upstream._tracker('default').samples) == 0
+    assert len(upstream._tracker('stream').samples) == 0